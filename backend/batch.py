@@ -0,0 +1,76 @@
+from typing import Dict, List, Optional
+import json
+import time
+import zipfile
+
+
+class ZipStream:
+    """ZIP archive built incrementally, with its bytes drained as it grows.
+
+    ZipFile treats the object as an unseekable stream and writes data
+    descriptors after each member, so members can be sent as soon as they
+    are added without knowing the rest of the archive.
+    """
+
+    def __init__(self):
+        self._chunks: List[bytes] = []
+        self._zip = zipfile.ZipFile(self, mode="w")
+
+    # File-like interface used by ZipFile
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def _drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+    def add(self, name: str, data: bytes, compress: bool = False) -> bytes:
+        """Append a member and return the archive bytes produced so far"""
+        info = zipfile.ZipInfo(name, date_time=time.localtime()[:6])
+        # Images are already compressed; only text members are deflated
+        info.compress_type = zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED
+        self._zip.writestr(info, data)
+        return self._drain()
+
+    def close(self) -> bytes:
+        """Write the central directory and return the final bytes"""
+        self._zip.close()
+        return self._drain()
+
+
+def parse_batch_params(
+    count: int,
+    size: Optional[int],
+    format: Optional[str],
+    params: Optional[str],
+) -> List[Dict]:
+    """Resolve the operation for each of count files.
+
+    size/format are shared defaults; params is an optional JSON array with
+    one object per file whose "size" or "format" key overrides them.
+    Raises ValueError for malformed input.
+    """
+    overrides = [{}] * count
+    if params:
+        try:
+            overrides = json.loads(params)
+        except ValueError:
+            raise ValueError("params must be a JSON array")
+        if not isinstance(overrides, list) or len(overrides) != count:
+            raise ValueError("params must be a JSON array with one entry per file")
+        if not all(isinstance(entry, dict) for entry in overrides):
+            raise ValueError("Each params entry must be an object")
+
+    resolved = []
+    for entry in overrides:
+        if "size" in entry or "format" in entry:
+            spec = {"size": entry.get("size"), "format": entry.get("format")}
+        else:
+            spec = {"size": size, "format": format}
+        resolved.append(spec)
+    return resolved
@@ -0,0 +1,372 @@
+"""Benchmarks for the resize and convert pipelines.
+
+Runs every endpoint in-process against a deterministic synthetic corpus and
+records latency, throughput, encode iterations and peak RSS as JSON:
+
+    python benchmark.py run --output bench_results.json
+    python benchmark.py run --quick --output bench_results.json
+    python benchmark.py compare baseline.json bench_results.json
+
+compare exits with status 1 when a metric regresses by more than
+--threshold (default 10%) against the baseline.
+"""
+from PIL import Image, ImageDraw, ImageFilter
+from io import BytesIO
+from typing import Dict, List, Optional, Tuple
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import resource
+import statistics
+import sys
+import time
+import uuid
+
+import PIL
+
+from config import Config
+
+SEED = 1234
+RESOLUTIONS = [(640, 480), (1920, 1080), (4000, 3000)]
+QUICK_RESOLUTIONS = [(640, 480)]
+# Source modes exercised for each format; to_rgb has dedicated
+# handling for RGBA, LA, P and CMYK. P-transparent is P with a
+# transparent palette entry, as in most transparent GIFs
+FORMAT_MODES = {
+    'JPEG': ['RGB', 'CMYK'],
+    'PNG': ['RGB', 'RGBA', 'LA', 'P', 'P-transparent'],
+    'GIF': ['P', 'P-transparent'],
+    'WEBP': ['RGB', 'RGBA'],
+    'BMP': ['RGB', 'P'],
+    'TIFF': ['RGB', 'RGBA', 'LA', 'P', 'CMYK'],
+}
+TARGET_SIZE_KB = 50
+# Extra targets for JPEG photos, where the search needs most encodes
+TARGET_SWEEP_KB = [20, 100, 300]
+CONVERT_TARGETS = ['jpg', 'png', 'webp']
+
+# Metrics where larger numbers are worse; everything else is better larger
+LOWER_IS_BETTER = {'p50_ms', 'p95_ms', 'mean_ms', 'iterations', 'peak_rss_mb', 'children_peak_rss_mb'}
+
+
+def synthetic_image(size: Tuple[int, int], seed: int) -> Image.Image:
+    """Deterministic photo-like RGB image: smooth regions, edges and texture"""
+    width, height = size
+    rng = random.Random(seed)
+    base = Image.merge('RGB', [
+        Image.effect_mandelbrot((width, height), (-2.0, -1.25, 0.75, 1.25), 64),
+        Image.linear_gradient('L').resize((width, height)),
+        Image.radial_gradient('L').resize((width, height)),
+    ])
+    draw = ImageDraw.Draw(base)
+    for _ in range(120):
+        x0, y0 = rng.randrange(width), rng.randrange(height)
+        x1, y1 = x0 + rng.randrange(width // 4 + 1), y0 + rng.randrange(height // 4 + 1)
+        color = tuple(rng.randrange(256) for _ in range(3))
+        if rng.random() < 0.5:
+            draw.ellipse((x0, y0, x1, y1), fill=color)
+        else:
+            draw.line((x0, y0, x1, y1), fill=color, width=rng.randrange(1, 8))
+    return base.filter(ImageFilter.GaussianBlur(1))
+
+
+def to_mode(img: Image.Image, mode: str) -> Image.Image:
+    """Convert the synthetic RGB image to a source mode"""
+    if mode == 'RGBA':
+        alpha = Image.radial_gradient('L').resize(img.size)
+        rgba = img.convert('RGBA')
+        rgba.putalpha(alpha)
+        return rgba
+    if mode == 'LA':
+        la = img.convert('LA')
+        la.putalpha(Image.linear_gradient('L').resize(img.size))
+        return la
+    if mode == 'P':
+        return img.quantize(256)
+    if mode == 'P-transparent':
+        indexed = img.quantize(256)
+        indexed.info['transparency'] = 0
+        return indexed
+    return img.convert(mode)
+
+
+def build_corpus(resolutions: List[Tuple[int, int]]) -> List[Dict]:
+    """Encode the synthetic image in every format/mode/resolution"""
+    registered = Image.registered_extensions()
+    formats = {registered[ext] for ext in Config.ALLOWED_EXTENSIONS}
+    extensions = {fmt: ext for ext, fmt in sorted(registered.items()) if ext in Config.ALLOWED_EXTENSIONS}
+
+    corpus = []
+    for index, size in enumerate(resolutions):
+        source = synthetic_image(size, SEED + index)
+        for fmt in sorted(formats):
+            for mode in FORMAT_MODES[fmt]:
+                output = BytesIO()
+                to_mode(source, mode).save(output, format=fmt)
+                corpus.append({
+                    "id": f"{fmt.lower()}-{mode}-{size[0]}x{size[1]}",
+                    "filename": f"bench{extensions[fmt]}",
+                    "content_type": Image.MIME[fmt],
+                    "data": output.getvalue(),
+                })
+    return corpus
+
+
+async def asgi_post(app, path: str, fields: Dict[str, str], item: Dict) -> Tuple[int, Dict[str, str], int, float]:
+    """POST a multipart upload straight into the ASGI app.
+
+    Returns (status, headers, body_bytes, seconds).
+    """
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in fields.items():
+        parts.append(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode()
+        )
+    parts.append(
+        f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{item["filename"]}"\r\n'
+        f'Content-Type: {item["content_type"]}\r\n\r\n'.encode() + item["data"] + b'\r\n'
+    )
+    parts.append(f'--{boundary}--\r\n'.encode())
+    body = b''.join(parts)
+
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1",
+        "method": "POST", "scheme": "http", "path": path, "raw_path": path.encode(),
+        "query_string": b"", "root_path": "", "client": ("127.0.0.1", 50000),
+        "server": ("benchmark", 80),
+        "headers": [
+            (b"host", b"benchmark"),
+            (b"content-type", f"multipart/form-data; boundary={boundary}".encode()),
+            (b"content-length", str(len(body)).encode()),
+        ],
+    }
+    done = asyncio.Event()
+    request_sent = False
+    status = 0
+    headers: Dict[str, str] = {}
+    received = 0
+
+    async def receive():
+        nonlocal request_sent
+        if not request_sent:
+            request_sent = True
+            return {"type": "http.request", "body": body, "more_body": False}
+        await done.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        nonlocal status, received
+        if message["type"] == "http.response.start":
+            status = message["status"]
+            headers.update((k.decode().lower(), v.decode()) for k, v in message.get("headers", []))
+        elif message["type"] == "http.response.body":
+            received += len(message.get("body", b""))
+            if not message.get("more_body", False):
+                done.set()
+
+    start = time.perf_counter()
+    await app(scope, receive, send)
+    return status, headers, received, time.perf_counter() - start
+
+
+def percentile(values: List[float], pct: float) -> float:
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def summarize(latencies: List[float]) -> Dict[str, float]:
+    millis = [latency * 1000 for latency in latencies]
+    return {
+        "runs": len(millis),
+        "p50_ms": round(statistics.median(millis), 2),
+        "p95_ms": round(percentile(millis, 95), 2),
+        "mean_ms": round(statistics.fmean(millis), 2),
+    }
+
+
+def requests_for(corpus: List[Dict]) -> List[Tuple[str, str, Dict[str, str], Dict]]:
+    """(case_id, path, form fields, corpus item) for every endpoint/input pair"""
+    requests = []
+    for item in corpus:
+        requests.append((f"process/{item['id']}", "/process-image/", {"size": str(TARGET_SIZE_KB)}, item))
+        requests.append((f"process-auto/{item['id']}", "/process-image/",
+                         {"size": str(TARGET_SIZE_KB), "output": "auto"}, item))
+        if item['id'].startswith('jpeg-RGB-'):
+            for target_kb in TARGET_SWEEP_KB:
+                requests.append((f"process-{target_kb}kb/{item['id']}", "/process-image/",
+                                 {"size": str(target_kb)}, item))
+        for target in CONVERT_TARGETS:
+            requests.append((f"convert-{target}/{item['id']}", "/convert-image/", {"format": target}, item))
+    return requests
+
+
+async def run_benchmarks(corpus: List[Dict], repeat: int, concurrency: int) -> Dict:
+    import main
+    from rate_limit import MemoryStore, RateLimiter
+    from result_cache import ResultCache
+
+    class PassThroughCache(ResultCache):
+        """Always recompute, so repeated inputs measure real work"""
+        async def get_or_compute(self, key, compute):
+            return await compute(), False
+
+    main.rate_limiter = RateLimiter(MemoryStore(), limit=sys.maxsize)
+    main.result_cache = PassThroughCache(max_bytes=0, disk_dir="")
+
+    requests = requests_for(corpus)
+    cases = {}
+    async with main.lifespan(main.app):
+        # Warm up worker processes so spawn cost is not charged to a case
+        for _, path, fields, item in requests[:main.image_executor.workers]:
+            await asgi_post(main.app, path, fields, item)
+
+        # Sequential: per-case latency
+        for case_id, path, fields, item in requests:
+            latencies, iterations, output_bytes = [], [], 0
+            for _ in range(repeat):
+                status, headers, received, seconds = await asgi_post(main.app, path, fields, item)
+                if status != 200:
+                    # Record unsupported combinations instead of aborting the run
+                    cases[case_id] = {"status": status}
+                    print(f"  {case_id:<40} HTTP {status}", file=sys.stderr)
+                    break
+                latencies.append(seconds)
+                output_bytes = received
+                if "x-encode-iterations" in headers:
+                    iterations.append(int(headers["x-encode-iterations"]))
+            if not latencies:
+                continue
+            case = summarize(latencies)
+            case["output_kb"] = round(output_bytes / 1024, 1)
+            if iterations:
+                case["iterations"] = max(iterations)
+            cases[case_id] = case
+            print(f"  {case_id:<40} p50 {case['p50_ms']:>9.1f} ms", file=sys.stderr)
+
+        # Concurrent: throughput with `concurrency` requests in flight
+        semaphore = asyncio.Semaphore(concurrency)
+        load_latencies = []
+
+        async def one(path, fields, item):
+            async with semaphore:
+                status, _, _, seconds = await asgi_post(main.app, path, fields, item)
+                if status == 200:
+                    load_latencies.append(seconds)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(one(path, fields, item) for _, path, fields, item in requests))
+        elapsed = time.perf_counter() - start
+        load = summarize(load_latencies) if load_latencies else {"runs": 0}
+        load.update(
+            concurrency=concurrency,
+            requests=len(requests),
+            failed=len(requests) - len(load_latencies),
+            throughput_rps=round(len(load_latencies) / elapsed, 2),
+        )
+
+    # Workers have exited by now, so RUSAGE_CHILDREN covers them
+    scale = 1024 if sys.platform != "darwin" else 1024 * 1024  # ru_maxrss is KB on Linux, bytes on macOS
+    return {
+        "cases": cases,
+        "load": load,
+        "memory": {
+            "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale, 1),
+            "children_peak_rss_mb": round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale, 1),
+        },
+    }
+
+
+def run(args) -> int:
+    resolutions = QUICK_RESOLUTIONS if args.quick else RESOLUTIONS
+    print(f"Building corpus for {len(resolutions)} resolution(s)...", file=sys.stderr)
+    corpus = build_corpus(resolutions)
+    results = asyncio.run(run_benchmarks(corpus, args.repeat, args.concurrency))
+    results["meta"] = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "pillow": PIL.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "worker_executor": Config.WORKER_EXECUTOR,
+        "worker_processes": Config.WORKER_PROCESSES,
+        "corpus_images": len(corpus),
+        "repeat": args.repeat,
+        "quick": args.quick,
+    }
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print(f"Wrote {args.output}", file=sys.stderr)
+    return 0
+
+
+def flatten(results: Dict) -> Dict[str, float]:
+    """Metric path -> value for every numeric metric in a results file"""
+    flat = {}
+    for case_id, metrics in results.get("cases", {}).items():
+        for name, value in metrics.items():
+            flat[f"cases/{case_id}/{name}"] = value
+    for section in ("load", "memory"):
+        for name, value in results.get(section, {}).items():
+            flat[f"{section}/{name}"] = value
+    return flat
+
+
+def compare(args) -> int:
+    with open(args.baseline) as f:
+        baseline = flatten(json.load(f))
+    with open(args.current) as f:
+        current = flatten(json.load(f))
+
+    regressions = []
+    for path in sorted(baseline.keys() & current.keys()):
+        name = path.rsplit("/", 1)[-1]
+        if name not in LOWER_IS_BETTER and name != "throughput_rps":
+            continue
+        old, new = baseline[path], current[path]
+        if not old:
+            continue
+        change = (new - old) / old
+        worse = change > args.threshold if name in LOWER_IS_BETTER else change < -args.threshold
+        if worse:
+            regressions.append((path, old, new, change))
+
+    # A case that used to succeed and now fails is always a regression
+    for path in sorted(baseline):
+        if path.endswith("/runs") and baseline[path] and path[:-len("runs")] + "status" in current:
+            regressions.append((path, baseline[path], 0, -1.0))
+
+    for path, old, new, change in regressions:
+        print(f"REGRESSION {path}: {old} -> {new} ({change:+.1%})")
+    missing = sorted(baseline.keys() - current.keys())
+    if missing:
+        print(f"{len(missing)} baseline metric(s) missing from current results")
+    print(f"{len(regressions)} regression(s) over {args.threshold:.0%} threshold")
+    return 1 if regressions else 0
+
+
+def main_cli(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark the image pipelines")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="run the benchmark suite")
+    run_parser.add_argument("--output", default="bench_results.json")
+    run_parser.add_argument("--repeat", type=int, default=3, help="runs per case")
+    run_parser.add_argument("--concurrency", type=int, default=Config.WORKER_PROCESSES * 2)
+    run_parser.add_argument("--quick", action="store_true", help="smallest resolution only")
+
+    compare_parser = commands.add_parser("compare", help="flag regressions against a baseline")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current")
+    compare_parser.add_argument("--threshold", type=float, default=0.10)
+
+    args = parser.parse_args(argv)
+    return run(args) if args.command == "run" else compare(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
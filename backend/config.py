@@ -1,4 +1,5 @@
 import os
+import tempfile
 from typing import List
 
 class Config:
@@ -11,6 +12,9 @@ class Config:
     # Security Settings
     MAX_FILE_SIZE = int(os.getenv("MAX_FILE_SIZE", 10 * 1024 * 1024))  # 10MB default
     MAX_REQUESTS_PER_MINUTE = int(os.getenv("MAX_REQUESTS_PER_MINUTE", 30))
+    # Whole request bodies, checked against Content-Length before the upload is read
+    MAX_REQUEST_SIZE = MAX_FILE_SIZE + 64 * 1024  # one file plus form overhead
+    BATCH_MAX_REQUEST_SIZE = int(os.getenv("BATCH_MAX_REQUEST_SIZE", 200 * 1024 * 1024))
     
     # Allowed file types
     ALLOWED_EXTENSIONS = {
@@ -34,6 +38,9 @@ class Config:
     # Rate Limiting
     RATE_LIMIT_WINDOW = 60  # seconds
     RATE_LIMIT_MAX_REQUESTS = MAX_REQUESTS_PER_MINUTE
+    RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "memory")  # "memory" or "file" (shared by workers)
+    RATE_LIMIT_FILE = os.getenv("RATE_LIMIT_FILE", os.path.join(tempfile.gettempdir(), "image-api-ratelimit"))
+    RATE_LIMIT_SLOTS = int(os.getenv("RATE_LIMIT_SLOTS", 65536))  # clients tracked by the file backend
     
     # Security Headers
     SECURITY_HEADERS = {
@@ -46,9 +53,58 @@ class Config:
     
     # File Processing
     MAX_IMAGE_DIMENSIONS = (8000, 8000)  # Maximum width/height
+    MAX_IMAGE_PIXELS = int(os.getenv("MAX_IMAGE_PIXELS", 50_000_000))  # decompression bomb guard
+    # Animated/multi-page inputs: frame count and pixels summed over all frames
+    MAX_FRAMES = int(os.getenv("MAX_FRAMES", 1000))
+    MAX_TOTAL_PIXELS = int(os.getenv("MAX_TOTAL_PIXELS", 100_000_000))
+    # Pillow decoders tried by header sniffing (JPEG also yields MPO for camera files)
+    ALLOWED_IMAGE_FORMATS = ('JPEG', 'PNG', 'GIF', 'WEBP', 'BMP', 'TIFF')
     MIN_QUALITY = 10
     MAX_QUALITY = 95
-    
+
+    # Target-size search
+    TARGET_SIZE_TOLERANCE_KB = 2
+    TARGET_SIZE_MAX_ENCODES = int(os.getenv("TARGET_SIZE_MAX_ENCODES", 10))  # full-resolution encodes
+    TARGET_SIZE_PROXY_EDGE = 512  # long edge of the estimation proxy
+    DECODE_SHRINK_MARGIN = 2.0  # decode at least this much above the estimated output size
+    ENCODER_EFFORT = os.getenv("ENCODER_EFFORT", "balanced")  # fast, balanced or best
+
+    # Responsive variants (/variants/)
+    VARIANT_MAX_COUNT = int(os.getenv("VARIANT_MAX_COUNT", 32))  # widths x formats per request
+    VARIANT_MIN_WIDTH = 16
+    VARIANT_QUALITY = 80  # quality for variants without a KB budget
+
+    # Worker pool for CPU-bound image work
+    WORKER_EXECUTOR = os.getenv("WORKER_EXECUTOR", "process")  # "process" or "thread"
+    WORKER_PROCESSES = int(os.getenv("WORKER_PROCESSES", os.cpu_count() or 1))
+    WORKER_QUEUE_SIZE = int(os.getenv("WORKER_QUEUE_SIZE", 32))  # jobs waiting beyond busy workers
+    WORKER_JOB_TIMEOUT = float(os.getenv("WORKER_JOB_TIMEOUT", 30))  # seconds
+    WORKER_RETRY_AFTER = 5  # seconds, sent with 503 when the queue is full
+
+    # Result cache
+    CACHE_MAX_BYTES = int(os.getenv("CACHE_MAX_BYTES", 64 * 1024 * 1024))  # in-memory budget
+    CACHE_DIR = os.getenv("CACHE_DIR")  # optional on-disk tier; unset disables it
+    CACHE_DISK_MAX_BYTES = int(os.getenv("CACHE_DISK_MAX_BYTES", 512 * 1024 * 1024))
+    # Disk hits at least this large are sent from the file in chunks rather than loaded
+    CACHE_DISK_STREAM_BYTES = int(os.getenv("CACHE_DISK_STREAM_BYTES", 1024 * 1024))
+
+    # Background jobs (/jobs/)
+    JOB_STORE = os.getenv("JOB_STORE", "memory")  # "memory" or "sqlite"
+    JOB_DB_PATH = os.getenv("JOB_DB_PATH", os.path.join(tempfile.gettempdir(), "image-api-jobs.sqlite3"))
+    JOB_QUEUE_DEPTH = int(os.getenv("JOB_QUEUE_DEPTH", 64))  # queued jobs before 429
+    JOB_WORKERS = int(os.getenv("JOB_WORKERS", WORKER_PROCESSES))
+    JOB_RESULT_TTL = int(os.getenv("JOB_RESULT_TTL", 600))  # seconds a finished job is kept
+    JOB_RETRY_AFTER = 10  # seconds, sent with 429 when the job queue is full
+    JOB_POLL_MAX_REQUESTS = int(os.getenv("JOB_POLL_MAX_REQUESTS", 300))  # per minute, GET /jobs/...
+    JOB_HEARTBEAT = 10  # seconds between SQLite store liveness updates; 3 missed = worker gone
+
+    # Observability
+    METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() == "true"  # expose /metrics
+
+    # Batch endpoint
+    BATCH_MAX_FILES = int(os.getenv("BATCH_MAX_FILES", 200))
+    BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", WORKER_PROCESSES))  # files processed at once per batch
+
     # Validation
     MIN_SIZE_KB = 10
     MAX_SIZE_KB = 1000
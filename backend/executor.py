@@ -0,0 +1,115 @@
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, Optional
+import asyncio
+import multiprocessing
+
+from config import Config
+
+
+class QueueFullError(Exception):
+    """Raised when the executor already holds its maximum number of jobs"""
+
+
+class JobTimeoutError(Exception):
+    """Raised when a job does not finish within the configured timeout"""
+
+
+class WorkerCrashedError(Exception):
+    """Raised when the worker process running a job died (OOM kill, segfault)"""
+
+
+class ImageExecutor:
+    """Runs CPU-bound image work off the event loop.
+
+    Jobs go to a process pool (or a thread pool when WORKER_EXECUTOR is
+    "thread"). At most workers + queue_size jobs are admitted at once;
+    further submissions fail fast with QueueFullError instead of piling up.
+    A worker that dies breaks a process pool for good, so the pool is then
+    replaced and only the jobs it was running fail.
+    """
+
+    def __init__(
+        self,
+        workers: Optional[int] = None,
+        queue_size: Optional[int] = None,
+        timeout: Optional[float] = None,
+        kind: Optional[str] = None,
+    ):
+        self.workers = workers or Config.WORKER_PROCESSES
+        self.queue_size = Config.WORKER_QUEUE_SIZE if queue_size is None else queue_size
+        self.timeout = timeout or Config.WORKER_JOB_TIMEOUT
+        self.kind = kind or Config.WORKER_EXECUTOR
+        self._pool: Optional[Executor] = None
+        self._pending = 0
+
+    @property
+    def capacity(self) -> int:
+        return self.workers + self.queue_size
+
+    @property
+    def pending(self) -> int:
+        return self._pending
+
+    def start(self):
+        """Create the underlying pool"""
+        if self._pool is not None:
+            return
+        if self.kind == "thread":
+            self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="image-worker")
+        else:
+            # spawn avoids forking the running event loop and its threads
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+
+    def shutdown(self, wait: bool = True):
+        """Stop accepting work and tear down the pool"""
+        if self._pool is None:
+            return
+        self._pool.shutdown(wait=wait, cancel_futures=True)
+        self._pool = None
+
+    def _replace_pool(self, broken: Executor):
+        """Swap a broken pool for a fresh one, once per breakage"""
+        if self._pool is broken:
+            self._pool = None
+            broken.shutdown(wait=False, cancel_futures=True)
+            self.start()
+
+    def _release(self, _future):
+        self._pending -= 1
+
+    async def run(self, func: Callable[..., Any], *args) -> Any:
+        """Run func(*args) in the pool and await its result"""
+        if self._pool is None:
+            self.start()
+        if self._pending >= self.capacity:
+            raise QueueFullError("Image worker queue is full")
+
+        loop = asyncio.get_running_loop()
+        pool = self._pool
+        try:
+            future = pool.submit(func, *args)
+        except BrokenProcessPool:
+            # Broken by an earlier job; this one has not run yet
+            self._replace_pool(pool)
+            pool = self._pool
+            future = pool.submit(func, *args)
+        self._pending += 1
+        # The slot is freed when the job really ends, so a timed-out job
+        # still counts against capacity while its worker is busy. Done
+        # callbacks fire on a pool thread, hence the hop back to the loop.
+        future.add_done_callback(lambda f: loop.call_soon_threadsafe(self._release, f))
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), self.timeout)
+        except asyncio.TimeoutError:
+            future.cancel()
+            raise JobTimeoutError(f"Image job exceeded {self.timeout:g}s")
+        except BrokenProcessPool:
+            self._replace_pool(pool)
+            raise WorkerCrashedError("Image worker exited while running the job")
+
+
+image_executor = ImageExecutor()
@@ -0,0 +1,136 @@
+from PIL import GifImagePlugin, Image, ImageChops, ImageSequence
+from typing import BinaryIO, Iterator, List, Optional, Tuple
+
+# Sources whose extra frames or pages are carried over, and the outputs
+# that can hold them; other pairs keep the first frame only
+ANIMATED_SOURCES = ('GIF', 'PNG', 'WEBP', 'TIFF')
+ANIMATED_OUTPUTS = ('GIF', 'WEBP', 'TIFF')
+
+# Frame duration (ms) for multi-page sources that carry no timing, e.g. TIFF
+DEFAULT_FRAME_DURATION = 100
+
+# Modes each encoder writes natively; other modes are converted first
+SAVE_MODES = {
+    'JPEG': ('L', 'RGB', 'CMYK'),
+    'PNG': ('1', 'L', 'LA', 'I', 'I;16', 'P', 'RGB', 'RGBA'),
+    'GIF': ('1', 'L', 'P', 'RGB', 'RGBA'),
+    'BMP': ('1', 'L', 'P', 'RGB'),
+    'WEBP': ('RGB', 'RGBA'),
+}
+
+
+def is_animated(img: Image.Image) -> bool:
+    """Whether img has more than one frame or page worth keeping"""
+    return img.format in ANIMATED_SOURCES and getattr(img, 'is_animated', False)
+
+
+def prepare_frame(img: Image.Image, fmt: str) -> Image.Image:
+    """Convert a single frame to a mode the fmt encoder accepts"""
+    if fmt in ['JPEG', 'BMP', 'WEBP'] and img.mode in ('RGBA', 'LA', 'P'):
+        img = img.convert('RGB')
+    accepted = SAVE_MODES.get(fmt)
+    if accepted and img.mode not in accepted:
+        # e.g. CMYK or YCbCr into PNG
+        img = img.convert('RGBA' if img.has_transparency_data else 'RGB')
+    return img
+
+
+def _duration(frame: Image.Image) -> int:
+    return frame.info.get('duration') or DEFAULT_FRAME_DURATION
+
+
+def _gif_frame(region: Image.Image, clear: bool = False) -> Tuple[Image.Image, Optional[int]]:
+    """Palette-encode one RGBA frame region; returns (image, transparent index).
+
+    A transparent index is also set aside when clear is true: decoders
+    restore a disposed frame to its transparent index, not the background
+    colour, so clearing an opaque frame needs one too.
+    """
+    alpha = region.getchannel('A')
+    rgb = region.convert('RGB')
+    if alpha.getextrema()[0] == 255 and not clear:
+        return rgb.quantize(256), None
+    # Reserve the last palette entry for pixels that are mostly transparent
+    indexed = rgb.quantize(255)
+    indexed.paste(255, mask=alpha.point(lambda a: 255 if a < 128 else 0))
+    palette = indexed.getpalette()
+    indexed.putpalette(palette + [0] * (768 - len(palette)))
+    return indexed, 255
+
+
+def _rgba_frames(img: Image.Image) -> Iterator[Tuple[Image.Image, bool, int]]:
+    """(RGBA frame, whether fully opaque, duration) for each frame of img"""
+    for frame in ImageSequence.Iterator(img):
+        rgba = frame.convert('RGBA')
+        yield rgba, rgba.getchannel('A').getextrema()[0] == 255, _duration(frame)
+
+
+def _save_gif(img: Image.Image, fp: BinaryIO) -> int:
+    """Write every frame of img as an animated GIF, one frame at a time.
+
+    Pillow's own save_all keeps all frames to diff them, so frames are
+    quantized and written individually instead, each with a local palette
+    and its source duration. Only the previous and next frames are kept:
+    opaque frames are cropped to the area that changed since the previous
+    one. Frames that have transparency, or are followed by a frame that
+    has, are written whole with restore-to-background disposal so nothing
+    shows through the transparent pixels. Returns the frame count.
+    """
+    loop = img.info.get('loop', 0)
+    frames = _rgba_frames(img)
+    current = next(frames, None)
+    previous = None
+    count = 0
+    while current is not None:
+        rgba, opaque, duration = current
+        current = next(frames, None)
+        clear = not opaque or (current is not None and not current[1])
+        bbox = (0, 0) + rgba.size
+        if previous is not None and not clear:
+            # Unchanged frames still need a (1x1) entry to keep their delay
+            bbox = ImageChops.difference(rgba, previous).getbbox(alpha_only=False) or (0, 0, 1, 1)
+        indexed, transparency = _gif_frame(rgba.crop(bbox), clear)
+        params = {'duration': duration, 'disposal': 2 if clear else 1}
+        if transparency is not None:
+            params['transparency'] = transparency
+        if count == 0:
+            header, _ = GifImagePlugin.getheader(indexed, info={'loop': loop, **params})
+            fp.write(b''.join(header))
+        else:
+            params['include_color_table'] = True
+        fp.write(b''.join(GifImagePlugin.getdata(indexed, bbox[:2], **params)))
+        # A cleared frame leaves nothing on the canvas to diff against
+        previous = None if clear else rgba
+        count += 1
+    fp.write(b';')  # trailer
+    return count
+
+
+def _durations(img: Image.Image) -> List[int]:
+    """Per-frame durations; WebP and GIF only expose them once a frame loads"""
+    durations = []
+    for frame in ImageSequence.Iterator(img):
+        frame.load()
+        durations.append(_duration(frame))
+    img.seek(0)
+    return durations
+
+
+def save_frames(img: Image.Image, fp: BinaryIO, fmt: str) -> int:
+    """Write all frames of an animated or multi-page img to fp as fmt.
+
+    Frames are decoded, converted and encoded one at a time, so peak memory
+    is a few frames whatever the frame count. Returns the frame count.
+    """
+    if fmt == 'GIF':
+        return _save_gif(img, fp)
+    if fmt == 'WEBP':
+        # The WebP muxer takes one timestamp step for every frame unless
+        # given a list, so durations are collected up front
+        durations = _durations(img)
+        img.save(fp, format=fmt, save_all=True, duration=durations, loop=img.info.get('loop', 0))
+        return len(durations)
+    # TIFF: Pillow seeks and appends one page at a time; pages are
+    # compressed so the output does not hold every frame's raw pixels
+    img.save(fp, format=fmt, save_all=True, compression='tiff_deflate')
+    return img.n_frames
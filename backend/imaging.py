@@ -0,0 +1,185 @@
+from PIL import Image
+from io import BytesIO
+from typing import Dict, Optional, Tuple
+import math
+import time
+
+from config import Config
+from frames import ANIMATED_OUTPUTS, is_animated, prepare_frame, save_frames
+from target_size import (
+    ENCODERS, Encoder, encode_to_target_size, estimate_candidates, estimate_start, pick_encoder,
+)
+
+# Map user-friendly format to PIL format
+FORMAT_MAP = {
+    'jpg': 'JPEG', 'jpeg': 'JPEG',
+    'png': 'PNG',
+    'gif': 'GIF',
+    'webp': 'WEBP',
+    'bmp': 'BMP',
+    'tiff': 'TIFF', 'tif': 'TIFF',
+}
+
+# Output modes of the target-size path: a fixed encoder, or "auto" to pick one
+TARGET_OUTPUTS = ('auto',) + tuple(ENCODERS)
+
+MEDIA_TYPES = {
+    'JPEG': 'image/jpeg',
+    'PNG': 'image/png',
+    'GIF': 'image/gif',
+    'WEBP': 'image/webp',
+    'BMP': 'image/bmp',
+    'TIFF': 'image/tiff',
+}
+
+
+def to_rgb(img):
+    """Flatten any image mode to RGB (alpha composited over white)"""
+    # Handle different image modes
+    if img.mode == 'LA':
+        # Convert LA (grayscale with alpha) to RGB
+        img = img.convert('RGB')
+    elif img.mode == 'RGBA':
+        # Convert RGBA to RGB with white background
+        background = Image.new('RGB', img.size, (255, 255, 255))
+        background.paste(img, mask=img.split()[-1])
+        img = background
+    elif 'transparency' in img.info:
+        # Palette or tRNS transparency (GIF, PNG): composite over white as
+        # for RGBA; a plain convert would keep a stale transparency key
+        rgba = img.convert('RGBA')
+        img = Image.new('RGB', img.size, (255, 255, 255))
+        img.paste(rgba, mask=rgba.getchannel('A'))
+    elif img.mode == 'P':
+        # Convert palette mode to RGB
+        img = img.convert('RGB')
+    elif img.mode != 'RGB':
+        # Convert any other mode to RGB
+        img = img.convert('RGB')
+    return img
+
+
+def decode_for_target(
+    data: bytes, target_size_kb, output: str = 'jpeg'
+) -> Tuple[Image.Image, Tuple[float, int], Encoder]:
+    """Decode data at no more resolution than a target-size encode needs.
+
+    The output scale is estimated first from a cheap rendition (a 1/8
+    DCT-domain JPEG draft, or the decoded image for other formats). JPEGs
+    are then decoded with draft() at the smallest power-of-two reduction
+    that still covers the estimated output size times
+    DECODE_SHRINK_MARGIN; other formats are fully decoded (they have no
+    reduced decode) and shrunk with reduce() before the search. With
+    output "auto" every candidate is estimated on that rendition and the
+    encoder is picked on the decoded image. Returns the image, a
+    (scale, quality) search start relative to it and the encoder.
+    """
+    img = Image.open(BytesIO(data))
+    full_size = img.size
+
+    is_jpeg = img.format in ('JPEG', 'MPO')
+    if is_jpeg:
+        preview = Image.open(BytesIO(data))
+        preview.draft('RGB', (Config.TARGET_SIZE_PROXY_EDGE, Config.TARGET_SIZE_PROXY_EDGE))
+        preview = to_rgb(preview)
+    else:
+        # reduce() does not handle every mode (e.g. P), so flatten first
+        img = to_rgb(img)
+        preview = img.reduce(max(1, max(full_size) // Config.TARGET_SIZE_PROXY_EDGE))
+    if output == 'auto':
+        # Decode for the candidate that needs the most resolution; the
+        # choice itself is made on the decoded pixels below
+        estimates = estimate_candidates(preview, target_size_kb, full_size)
+        scale = max(scale for scale, _ in estimates.values())
+    else:
+        encoder = ENCODERS[output]
+        scale, quality, _ = estimate_start(preview, target_size_kb, full_size, encoder)
+
+    factor = int(1 / (scale * Config.DECODE_SHRINK_MARGIN)) if scale < 1 else 1
+    if factor >= 2:
+        needed = (
+            max(1, math.ceil(full_size[0] / factor)),
+            max(1, math.ceil(full_size[1] / factor)),
+        )
+        if is_jpeg:
+            img.draft(img.mode, needed)
+        else:
+            img = img.reduce(factor)
+    img.load()
+
+    # Re-express estimated scales against the decoded resolution
+    if output == 'auto':
+        relative = {
+            name: (scale * full_size[0] / img.width, quality)
+            for name, (scale, quality) in estimates.items()
+        }
+        name = pick_encoder(to_rgb(img), relative)
+        return img, relative[name], ENCODERS[name]
+    return img, (scale * full_size[0] / img.width, quality), encoder
+
+
+# The functions below are the units of work submitted to the worker pool:
+# they take and return plain bytes so they can cross process boundaries.
+
+def resize_image_bytes(
+    data: bytes, target_size_kb: int, output: str = 'jpeg', effort: Optional[str] = None
+) -> Tuple[bytes, Dict]:
+    """Decode data and encode it near target_size_kb.
+
+    output is one of TARGET_OUTPUTS and effort one of EFFORT_LEVELS.
+    Returns (image_bytes, stats) where stats holds the chosen encoder and
+    PIL format, the encode iteration count and per-stage timings for the
+    metrics layer.
+    """
+    started = time.perf_counter()
+    img, start, encoder = decode_for_target(data, target_size_kb, output)
+    decoded = time.perf_counter()
+    with img:
+        rgb = to_rgb(img)
+        converted = time.perf_counter()
+        result = encode_to_target_size(rgb, target_size_kb, start=start, encoder=encoder, effort=effort)
+    stats = {
+        "encoder": encoder.name,
+        "format": encoder.format,
+        "iterations": result.iterations,
+        "stages": {"decode": decoded - started, "mode": converted - decoded},
+        "encodes": result.encode_seconds,
+        "worker": time.perf_counter() - started,
+    }
+    return result.buffer.getvalue(), stats
+
+
+def convert_image_bytes(data: bytes, fmt: str) -> Tuple[bytes, Dict]:
+    """Decode data and re-encode it in the PIL format fmt.
+
+    Animated GIF/PNG/WebP and multi-page TIFF inputs keep every frame when
+    fmt can hold them; frames are then streamed through one at a time.
+    Returns (image_bytes, stats) with per-stage timings.
+    """
+    started = time.perf_counter()
+    output_io = BytesIO()
+    with Image.open(BytesIO(data)) as img:
+        if fmt in ANIMATED_OUTPUTS and is_animated(img):
+            # Decode and encode interleave per frame, so time them as one pass
+            save_frames(img, output_io, fmt)
+            finished = time.perf_counter()
+            stats = {
+                "stages": {},
+                "encodes": (finished - started,),
+                "worker": finished - started,
+            }
+            return output_io.getvalue(), stats
+
+        img.load()
+        decoded = time.perf_counter()
+        frame = prepare_frame(img, fmt)
+        converted = time.perf_counter()
+
+        frame.save(output_io, format=fmt)
+    finished = time.perf_counter()
+    stats = {
+        "stages": {"decode": decoded - started, "mode": converted - decoded},
+        "encodes": (finished - converted,),
+        "worker": finished - started,
+    }
+    return output_io.getvalue(), stats
@@ -0,0 +1,85 @@
+from PIL import Image
+from typing import BinaryIO, NamedTuple, Optional, Tuple
+import os
+import warnings
+
+from config import Config
+
+# Register every plugin up front: Image.open(formats=...) only looks at
+# plugins that are already loaded, and WEBP/TIFF are loaded lazily
+Image.init()
+
+
+class UploadRejected(Exception):
+    """Raised when an upload fails ingestion checks"""
+
+    def __init__(self, status_code: int, detail: str):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+
+
+class ImageHeader(NamedTuple):
+    """What the image header says, read without decoding pixels"""
+    format: str
+    mode: str
+    size: Tuple[int, int]
+    frames: int = 1
+
+
+def _stream_size(stream: BinaryIO) -> int:
+    stream.seek(0, os.SEEK_END)
+    size = stream.tell()
+    stream.seek(0)
+    return size
+
+
+def sniff_header(stream: BinaryIO, size: Optional[int] = None) -> ImageHeader:
+    """Identify an upload from its header and enforce size limits.
+
+    Only the bytes Pillow needs to parse the header are read, so a bogus or
+    oversized upload is rejected before it is buffered or decoded. For
+    animated and multi-page images the frame headers are walked too, since
+    conversions decode every frame. Raises UploadRejected.
+    """
+    if size is None:
+        size = _stream_size(stream)
+    if size > Config.MAX_FILE_SIZE:
+        raise UploadRejected(413, f"File too large. Maximum size is {Config.MAX_FILE_SIZE // (1024 * 1024)}MB.")
+    if size == 0:
+        raise UploadRejected(400, "Empty file.")
+
+    stream.seek(0)
+    try:
+        with warnings.catch_warnings():
+            # Pillow only warns for moderately large images; treat as fatal
+            warnings.simplefilter("error", Image.DecompressionBombWarning)
+            img = Image.open(stream, formats=Config.ALLOWED_IMAGE_FORMATS)
+        # Counting skips frame data; GIF and TIFF step through each frame header
+        header = ImageHeader(img.format, img.mode, img.size, getattr(img, "n_frames", 1))
+    except Exception:
+        # Unknown formats, truncated headers and decompression bombs
+        raise UploadRejected(400, "Invalid file type or size. Please upload a valid image file (max 10MB).")
+    finally:
+        stream.seek(0)
+
+    width, height = header.size
+    max_width, max_height = Config.MAX_IMAGE_DIMENSIONS
+    if width > max_width or height > max_height:
+        raise UploadRejected(
+            400,
+            f"Image dimensions exceed the maximum of {max_width}x{max_height} pixels."
+        )
+    if width * height > Config.MAX_IMAGE_PIXELS:
+        raise UploadRejected(
+            400,
+            f"Image has too many pixels. At most {Config.MAX_IMAGE_PIXELS:,} pixels are allowed."
+        )
+    if header.frames > Config.MAX_FRAMES or header.frames * width * height > Config.MAX_TOTAL_PIXELS:
+        raise UploadRejected(
+            400,
+            f"Animation too large. At most {Config.MAX_FRAMES} frames and "
+            f"{Config.MAX_TOTAL_PIXELS:,} pixels across all frames are allowed."
+        )
+    return header
+
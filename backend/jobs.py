@@ -0,0 +1,257 @@
+from typing import Awaitable, Callable, Dict, Optional
+import asyncio
+import json
+import logging
+import secrets
+import sqlite3
+import threading
+import time
+
+from config import Config
+from executor import QueueFullError
+from result_cache import CachedResult
+
+QUEUED, RUNNING, DONE, FAILED = "queued", "running", "done", "failed"
+
+logger = logging.getLogger(__name__)
+
+
+class MemoryJobStore:
+    """Job records and results in a per-process dict"""
+
+    def __init__(self):
+        self._jobs: Dict[str, Dict] = {}
+
+    async def create(self, job_id: str, filename: str):
+        self._jobs[job_id] = {
+            "job_id": job_id, "status": QUEUED, "filename": filename,
+            "created": time.time(), "finished": None,
+            "error": None, "error_status": None, "result": None,
+        }
+
+    async def update(self, job_id: str, **fields):
+        job = self._jobs.get(job_id)
+        if job is not None:
+            job.update(fields)
+
+    async def get(self, job_id: str) -> Optional[Dict]:
+        job = self._jobs.get(job_id)
+        return dict(job) if job is not None else None
+
+    async def purge(self, finished_before: float):
+        expired = [job_id for job_id, job in self._jobs.items()
+                   if job["finished"] is not None and job["finished"] < finished_before]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+    async def reap(self, seen_before: float):
+        pass
+
+    async def close(self):
+        pass
+
+
+class SQLiteJobStore:
+    """Job records and results in a local SQLite file.
+
+    Status and results are visible to every uvicorn worker using the same
+    file, so a client may poll any of them. Queued inputs only live in the
+    accepting worker's memory, so each job records its worker, workers
+    renew a heartbeat, and reap() fails the unfinished jobs of workers
+    that stopped renewing it.
+    """
+
+    def __init__(self, path: str):
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        # Random rather than the pid, which a restarted worker may reuse
+        self.owner = secrets.token_hex(8)
+        with self._lock, self._db:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                " job_id TEXT PRIMARY KEY, status TEXT, filename TEXT,"
+                " created REAL, finished REAL, error TEXT, error_status INTEGER,"
+                " media_type TEXT, headers TEXT, body BLOB, owner TEXT)"
+            )
+            if "owner" not in [row[1] for row in self._db.execute("PRAGMA table_info(jobs)")]:
+                # Files created before jobs recorded their worker
+                self._db.execute("ALTER TABLE jobs ADD COLUMN owner TEXT")
+            self._db.execute("CREATE TABLE IF NOT EXISTS owners (owner TEXT PRIMARY KEY, seen REAL)")
+            self._db.execute("INSERT INTO owners (owner, seen) VALUES (?, ?)", (self.owner, time.time()))
+
+    def _execute(self, sql: str, params=()):
+        with self._lock, self._db:
+            return self._db.execute(sql, params).fetchone()
+
+    async def create(self, job_id: str, filename: str):
+        await asyncio.to_thread(
+            self._execute,
+            "INSERT INTO jobs (job_id, status, filename, created, owner) VALUES (?, ?, ?, ?, ?)",
+            (job_id, QUEUED, filename, time.time(), self.owner),
+        )
+
+    async def update(self, job_id: str, **fields):
+        result = fields.pop("result", None)
+        if result is not None:
+            fields.update(media_type=result.media_type, headers=json.dumps(result.headers), body=result.body)
+        columns = ", ".join(f"{name} = ?" for name in fields)
+        await asyncio.to_thread(
+            self._execute, f"UPDATE jobs SET {columns} WHERE job_id = ?", (*fields.values(), job_id)
+        )
+
+    async def get(self, job_id: str) -> Optional[Dict]:
+        row = await asyncio.to_thread(
+            self._execute,
+            "SELECT job_id, status, filename, created, finished, error, error_status,"
+            " media_type, headers, body FROM jobs WHERE job_id = ?",
+            (job_id,),
+        )
+        if row is None:
+            return None
+        job = dict(zip(
+            ("job_id", "status", "filename", "created", "finished", "error", "error_status"), row[:7]
+        ))
+        media_type, headers, body = row[7:]
+        job["result"] = CachedResult(body, media_type, json.loads(headers)) if body is not None else None
+        return job
+
+    async def purge(self, finished_before: float):
+        await asyncio.to_thread(
+            self._execute, "DELETE FROM jobs WHERE finished IS NOT NULL AND finished < ?", (finished_before,)
+        )
+
+    def _fail_orphans(self, seen_before: float):
+        with self._lock, self._db:
+            # An upsert, so a worker that a peer reaped while it stalled comes back
+            self._db.execute(
+                "INSERT INTO owners (owner, seen) VALUES (?, ?)"
+                " ON CONFLICT(owner) DO UPDATE SET seen = excluded.seen",
+                (self.owner, time.time()),
+            )
+            self._db.execute("DELETE FROM owners WHERE seen < ?", (seen_before,))
+            self._db.execute(
+                "UPDATE jobs SET status = ?, error = ?, error_status = ?, finished = ?"
+                " WHERE status IN (?, ?) AND (owner IS NULL OR owner NOT IN (SELECT owner FROM owners))",
+                (FAILED, "Server restarted before the job finished.", 503, time.time(), QUEUED, RUNNING),
+            )
+
+    async def reap(self, seen_before: float):
+        """Renew this worker's heartbeat and fail jobs of workers not seen since seen_before"""
+        await asyncio.to_thread(self._fail_orphans, seen_before)
+
+    async def close(self):
+        # Jobs still queued here are lost with this worker's memory
+        await asyncio.to_thread(self._execute, "DELETE FROM owners WHERE owner = ?", (self.owner,))
+        await self.reap(0)
+        with self._lock:
+            self._db.close()
+
+
+class JobManager:
+    """Bounded queue of background jobs drained by a fixed set of workers.
+
+    submit() fails fast with QueueFullError once JOB_QUEUE_DEPTH jobs are
+    waiting. Finished jobs are purged JOB_RESULT_TTL seconds after they end.
+    """
+
+    def __init__(self, store=None, depth: Optional[int] = None, workers: Optional[int] = None,
+                 ttl: Optional[float] = None):
+        self.store = store
+        self.depth = depth or Config.JOB_QUEUE_DEPTH
+        self.workers = workers or Config.JOB_WORKERS
+        self.ttl = ttl or Config.JOB_RESULT_TTL
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks = []
+
+    @property
+    def queued(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    def start(self):
+        if self.store is None:
+            self.store = create_job_store()
+        self._queue = asyncio.Queue(maxsize=self.depth)
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self._purge_loop()))
+        self._tasks.append(asyncio.create_task(self._heartbeat_loop()))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        await self.store.close()
+
+    async def submit(self, run: Callable[[], Awaitable[CachedResult]], filename: str) -> str:
+        """Queue run() and return the new job id"""
+        if self._queue.full():
+            raise QueueFullError("Job queue is full")
+        job_id = secrets.token_urlsafe(16)
+        await self.store.create(job_id, filename)
+        # Re-check after the await: other submissions may have filled the queue
+        try:
+            self._queue.put_nowait((job_id, run))
+        except asyncio.QueueFull:
+            await self.store.update(job_id, status=FAILED, finished=time.time(),
+                                    error="Job queue is full.", error_status=429)
+            raise QueueFullError("Job queue is full")
+        return job_id
+
+    async def get(self, job_id: str) -> Optional[Dict]:
+        """Job record, or None if unknown or past its TTL"""
+        job = await self.store.get(job_id)
+        if job is not None and job["finished"] is not None and job["finished"] < time.time() - self.ttl:
+            return None
+        return job
+
+    async def _worker(self):
+        while True:
+            job_id, run = await self._queue.get()
+            try:
+                await self.store.update(job_id, status=RUNNING)
+                while True:
+                    try:
+                        result = await run()
+                        break
+                    except QueueFullError:
+                        # Worker pool saturated by synchronous traffic; wait for room
+                        await asyncio.sleep(Config.WORKER_RETRY_AFTER)
+                await self.store.update(job_id, status=DONE, finished=time.time(), result=result)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                await self.store.update(
+                    job_id, status=FAILED, finished=time.time(),
+                    error=getattr(e, "detail", None) or f"Error processing image: {str(e)}",
+                    error_status=getattr(e, "status_code", 500),
+                )
+            finally:
+                self._queue.task_done()
+
+    async def _heartbeat_loop(self):
+        while True:
+            try:
+                await self.store.reap(time.time() - 3 * Config.JOB_HEARTBEAT)
+            except Exception:
+                # e.g. "database is locked"; the next beat retries
+                logger.exception("Job store heartbeat failed")
+            await asyncio.sleep(Config.JOB_HEARTBEAT)
+
+    async def _purge_loop(self):
+        while True:
+            await asyncio.sleep(min(self.ttl, 60))
+            try:
+                await self.store.purge(time.time() - self.ttl)
+            except Exception:
+                logger.exception("Purging expired jobs failed")
+
+
+def create_job_store():
+    """Build the job store selected by JOB_STORE"""
+    if Config.JOB_STORE == "sqlite":
+        return SQLiteJobStore(Config.JOB_DB_PATH)
+    return MemoryJobStore()
+
+
+job_manager = JobManager()
@@ -1,24 +1,62 @@
 from fastapi import FastAPI, File, UploadFile, Form, HTTPException, Request
-from fastapi.responses import StreamingResponse
+from fastapi.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-from PIL import Image
-from io import BytesIO
+from contextlib import asynccontextmanager
 import uvicorn
 import os
 import time
-from typing import Dict, Set
+from typing import Dict, List, Optional, Set
+import asyncio
 import hashlib
+import json
 
-app = FastAPI(title="Image Converter API", version="1.0.0")
+from batch import ZipStream, parse_batch_params
+from config import Config
+from executor import JobTimeoutError, QueueFullError, WorkerCrashedError, image_executor
+from imaging import (
+    FORMAT_MAP, MEDIA_TYPES, TARGET_OUTPUTS, convert_image_bytes, resize_image_bytes,
+)
+from ingest import UploadRejected, sniff_header
+from jobs import DONE, FAILED, job_manager
+from metrics import (
+    CACHE_REQUESTS, IN_FLIGHT, REJECTIONS, REQUEST_SECONDS, STAGE_SECONDS, Gauge,
+    current_timer, record_worker_stats, registry, start_timer
+)
+from rate_limit import RateLimiter
+from responses import BufferResponse, FileBodyResponse
+from result_cache import CachedResult, cache_key, etag_matches, make_etag, result_cache
+from target_size import EFFORT_LEVELS
+from variants import build_variants, parse_variant_params
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Start the image worker pool and job queue with the app and stop them with it"""
+    image_executor.start()
+    job_manager.start()
+    yield
+    await job_manager.stop()
+    image_executor.shutdown()
+
+app = FastAPI(title="Image Converter API", version="1.0.0", lifespan=lifespan)
 
 # Security configuration
 MAX_FILE_SIZE = 10 * 1024 * 1024  # 10MB
 ALLOWED_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.gif', '.webp', '.bmp', '.tiff', '.tif'}
 ALLOWED_MIME_TYPES = {'image/jpeg', 'image/png', 'image/gif', 'image/webp', 'image/bmp', 'image/tiff'}
 
-# Rate limiting storage (in production, use Redis)
-request_timestamps: Dict[str, list] = {}
-MAX_REQUESTS_PER_MINUTE = 30
+# Rate limiting (RATE_LIMIT_BACKEND=file shares counters between workers)
+rate_limiter = RateLimiter()
+# Job status/result polls get a separate, larger budget: clients that follow
+# Retry-After would otherwise use up the limit meant for uploads
+poll_rate_limiter = RateLimiter(rate_limiter.store, limit=Config.JOB_POLL_MAX_REQUESTS)
+
+# Gauges sampled when /metrics is scraped
+registry.register(Gauge("image_jobs_in_flight", "Jobs queued or running in the worker pool",
+                        callback=lambda: image_executor.pending))
+registry.register(Gauge("jobs_queued", "Background jobs waiting for a worker",
+                        callback=lambda: job_manager.queued))
+registry.register(Gauge("result_cache_bytes", "Bytes held by the in-memory result cache",
+                        callback=lambda: result_cache.size_bytes))
 
 # Add CORS middleware with more restrictive settings
 app.add_middleware(
@@ -51,27 +89,6 @@ def validate_file(file: UploadFile) -> bool:
     
     return True
 
-def check_rate_limit(client_ip: str) -> bool:
-    """Simple rate limiting implementation"""
-    current_time = time.time()
-    
-    if client_ip not in request_timestamps:
-        request_timestamps[client_ip] = []
-    
-    # Remove timestamps older than 1 minute
-    request_timestamps[client_ip] = [
-        ts for ts in request_timestamps[client_ip] 
-        if current_time - ts < 60
-    ]
-    
-    # Check if too many requests
-    if len(request_timestamps[client_ip]) >= MAX_REQUESTS_PER_MINUTE:
-        return False
-    
-    # Add current request
-    request_timestamps[client_ip].append(current_time)
-    return True
-
 def get_client_ip(request: Request) -> str:
     """Get client IP address"""
     forwarded = request.headers.get("X-Forwarded-For")
@@ -79,83 +96,243 @@ def get_client_ip(request: Request) -> str:
         return forwarded.split(",")[0]
     return request.client.host
 
+# Status codes counted as rejections in /metrics
+REJECTION_REASONS = {
+    400: "invalid_request",
+    411: "length_required",
+    413: "too_large",
+    429: "rate_limited",
+    503: "queue_full",
+    504: "timeout",
+}
+
+async def _timed_body(body_iterator, path: str, status: int, started: float):
+    """Pass the body through, then record write time and request latency"""
+    write_started = time.perf_counter()
+    try:
+        async for chunk in body_iterator:
+            yield chunk
+    finally:
+        finished = time.perf_counter()
+        STAGE_SECONDS.observe(finished - write_started, "write")
+        REQUEST_SECONDS.observe(finished - started, path, str(status))
+        IN_FLIGHT.dec()
+
 @app.middleware("http")
 async def security_middleware(request: Request, call_next):
     """Security middleware for all requests"""
+    started = time.perf_counter()
+    timer = start_timer()
+    IN_FLIGHT.inc()
     client_ip = get_client_ip(request)
+    response = None
     
     # Rate limiting
-    if not check_rate_limit(client_ip):
-        return HTTPException(
+    if request.method == "GET" and request.url.path.startswith("/jobs/"):
+        allowed, retry_after = poll_rate_limiter.check(f"poll:{client_ip}")
+    else:
+        allowed, retry_after = rate_limiter.check(client_ip)
+    if not allowed:
+        response = JSONResponse(
             status_code=429, 
-            detail="Too many requests. Please try again later."
+            content={"detail": "Too many requests. Please try again later."},
+            headers={"Retry-After": str(retry_after)}
         )
     
-    # Add security headers
-    response = await call_next(request)
-    response.headers["X-Content-Type-Options"] = "nosniff"
-    response.headers["X-Frame-Options"] = "DENY"
-    response.headers["X-XSS-Protection"] = "1; mode=block"
-    response.headers["Referrer-Policy"] = "strict-origin-when-cross-origin"
+    # Reject oversized bodies from Content-Length, before the upload is read
+    elif request.method == "POST":
+        max_size = Config.BATCH_MAX_REQUEST_SIZE if request.url.path == "/batch/" else Config.MAX_REQUEST_SIZE
+        content_length = request.headers.get("Content-Length")
+        if content_length is None:
+            response = JSONResponse(status_code=411, content={"detail": "Content-Length required."})
+        elif not content_length.isdigit() or int(content_length) > max_size:
+            response = JSONResponse(status_code=413, content={"detail": "Request body too large."})
     
-    return response
-
-def adjust_image(img, target_size_kb):
-    # Convert image to RGB mode to ensure compatibility with JPEG 
-    print(f"Original image mode: {img.mode}")
-    
-    # Handle different image modes
-    if img.mode == 'LA':
-        # Convert LA (grayscale with alpha) to RGB
-        img = img.convert('RGB')
-    elif img.mode == 'RGBA':
-        # Convert RGBA to RGB with white background
-        background = Image.new('RGB', img.size, (255, 255, 255))
-        background.paste(img, mask=img.split()[-1])
-        img = background
-    elif img.mode == 'P':
-        # Convert palette mode to RGB
-        img = img.convert('RGB')
-    elif img.mode != 'RGB':
-        # Convert any other mode to RGB
-        img = img.convert('RGB')
+    if response is None:
+        try:
+            response = await call_next(request)
+        except BaseException:
+            IN_FLIGHT.dec()
+            raise
+        
+        # Add security headers
+        response.headers["X-Content-Type-Options"] = "nosniff"
+        response.headers["X-Frame-Options"] = "DENY"
+        response.headers["X-XSS-Protection"] = "1; mode=block"
+        response.headers["Referrer-Policy"] = "strict-origin-when-cross-origin"
+        if timer.stages:
+            response.headers["Server-Timing"] = timer.header()
     
-    print(f"Converted image mode: {img.mode}")
+    if response.status_code in REJECTION_REASONS:
+        REJECTIONS.inc(REJECTION_REASONS[response.status_code])
+    route_path = getattr(request.scope.get("route"), "path", "unmatched")
+    if hasattr(response, "body_iterator"):
+        response.body_iterator = _timed_body(response.body_iterator, route_path, response.status_code, started)
+    else:
+        REQUEST_SECONDS.observe(time.perf_counter() - started, route_path, str(response.status_code))
+        IN_FLIGHT.dec()
     
-    quality = 95
-    output_io = BytesIO()
+    return response
 
-    while True:
-        img.save(output_io, format="JPEG", quality=quality, optimize=True)
-        size_kb = len(output_io.getvalue()) / 1024
+def run_in_worker_error(e: Exception) -> HTTPException:
+    """Map executor errors to HTTP errors"""
+    if isinstance(e, QueueFullError):
+        return HTTPException(
+            status_code=503,
+            detail="Server is busy. Please try again shortly.",
+            headers={"Retry-After": str(Config.WORKER_RETRY_AFTER)}
+        )
+    if isinstance(e, WorkerCrashedError):
+        return HTTPException(
+            status_code=503,
+            detail="Image worker failed while processing this image. Please try again.",
+            headers={"Retry-After": str(Config.WORKER_RETRY_AFTER)}
+        )
+    return HTTPException(
+        status_code=504,
+        detail="Image processing took too long. Please try a smaller image."
+    )
 
-        if abs(size_kb - target_size_kb) <= 2:
-            break
+async def read_upload(file: UploadFile) -> bytes:
+    """Read an upload after its image header passes ingestion checks"""
+    timer = current_timer()
+    # Form parsing finishes before the endpoint runs
+    timer.lap("multipart")
+    try:
+        # Header parsing does blocking reads (the upload may be spooled to disk)
+        await asyncio.to_thread(sniff_header, file.file, file.size)
+    except UploadRejected as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail)
+    timer.lap("validate")
+    data = await file.read()
+    timer.lap("read")
+    return data
 
-        if size_kb > target_size_kb:
-            if quality > 10:
-                quality -= 5
-            else:
-                width, height = img.size
-                img = img.resize((int(width * 0.9), int(height * 0.9)), Image.LANCZOS)
-                quality = 95
-        else:
-            width, height = img.size
-            img = img.resize((int(width * 1.1), int(height * 1.1)), Image.LANCZOS)
-            quality = min(quality + 5, 95)
+def resize_job(data: bytes, size: int, output: str = 'jpeg', effort: Optional[str] = None):
+    """Cache key and compute coroutine for a target-size request"""
+    effort = effort or Config.ENCODER_EFFORT
+    async def compute() -> CachedResult:
+        started = time.perf_counter()
+        body, stats = await image_executor.run(resize_image_bytes, data, size, output, effort)
+        record_worker_stats(stats, time.perf_counter() - started)
+        headers = {"X-Encode-Iterations": str(stats["iterations"]), "X-Image-Encoder": stats["encoder"]}
+        return CachedResult(body, MEDIA_TYPES[stats["format"]], headers)
+    return cache_key(data, "resize", f"{size}:{output}:{effort}"), compute
 
-        output_io = BytesIO()  # reset buffer
+def convert_job(data: bytes, fmt: str):
+    """Cache key and compute coroutine for a format conversion request"""
+    media_type = MEDIA_TYPES.get(fmt, 'application/octet-stream')
+    async def compute() -> CachedResult:
+        started = time.perf_counter()
+        output, stats = await image_executor.run(convert_image_bytes, data, fmt)
+        record_worker_stats(stats, time.perf_counter() - started)
+        return CachedResult(output, media_type, {})
+    return cache_key(data, "convert", fmt), compute
 
-    output_io.seek(0)
-    return output_io
+def variants_job(data: bytes, specs: List[Dict], effort: Optional[str] = None):
+    """Cache key and compute coroutine for a responsive variants request"""
+    effort = effort or Config.ENCODER_EFFORT
+    async def compute() -> CachedResult:
+        started = time.perf_counter()
+        body, stats = await image_executor.run(build_variants, data, specs, effort)
+        record_worker_stats(stats, time.perf_counter() - started)
+        return CachedResult(body, "application/zip", {})
+    return cache_key(data, "variants", f"{json.dumps(specs, sort_keys=True)}:{effort}"), compute
+
+def file_extension(fmt: str) -> str:
+    """Output file extension for a PIL format"""
+    return fmt.lower() if fmt != 'JPEG' else 'jpg'
+
+# File extension for each output media type
+EXTENSIONS = {media_type: file_extension(fmt) for fmt, media_type in MEDIA_TYPES.items()}
+EXTENSIONS["application/zip"] = "zip"
+
+def check_effort(effort: Optional[str]):
+    """Reject an unknown encoder effort level"""
+    if effort is not None and effort not in EFFORT_LEVELS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unsupported effort: {effort}. Choose one of {', '.join(EFFORT_LEVELS)}."
+        )
+
+def resolve_operation(size, format):
+    """Validate a size/format choice for batch and job requests.
+
+    Returns (filename prefix, extension, job factory taking the input bytes).
+    """
+    if size is not None and format is not None:
+        raise HTTPException(status_code=400, detail="Specify either size or format, not both.")
+    if format is not None:
+        fmt = FORMAT_MAP.get(str(format).lower())
+        if not fmt:
+            raise HTTPException(status_code=400, detail=f"Unsupported format: {format}")
+        return "converted", file_extension(fmt), lambda data: convert_job(data, fmt)
+    if isinstance(size, int) and 10 <= size <= 1000:
+        return "processed", "jpg", lambda data: resize_job(data, size)
+    raise HTTPException(
+        status_code=400, 
+        detail="Target size must be between 10 and 1000 KB."
+    )
+
+async def compute_cached(key: str, compute):
+    """Fetch or compute a result through the cache; returns (result, hit)"""
+    try:
+        result, hit = await result_cache.get_or_compute(key, compute)
+    except (QueueFullError, JobTimeoutError, WorkerCrashedError) as e:
+        raise run_in_worker_error(e)
+    CACHE_REQUESTS.inc("hit" if hit else "miss")
+    return result, hit
+
+async def run_cached(request: Request, key: str, compute, filename_stem: str):
+    """Serve a result from the cache, computing it on a miss.
+
+    The download is named filename_stem plus the extension of the result's
+    media type. Returns 304 when If-None-Match already names this result's
+    ETag. The body is sent with an exact Content-Length, from memory or, for
+    large disk-tier hits, from the cached file.
+    """
+    etag = make_etag(key)
+    if etag_matches(request.headers.get("If-None-Match"), etag):
+        CACHE_REQUESTS.inc("not_modified")
+        return Response(status_code=304, headers={"ETag": etag})
+
+    result, hit = await compute_cached(key, compute)
+    file = None
+    while result.path is not None:
+        try:
+            file = await asyncio.to_thread(open, result.path, "rb")
+            break
+        except OSError:
+            # Evicted from the disk tier since the lookup; compute it again
+            result, hit = await compute_cached(key, compute)
+    filename = f"{filename_stem}.{EXTENSIONS.get(result.media_type, 'bin')}"
+    headers = {
+        "Content-Disposition": f"attachment; filename={filename}",
+        "Cache-Control": "private, no-cache",
+        "ETag": etag,
+        "X-Cache": "HIT" if hit else "MISS",
+        **result.headers
+    }
+
+    if file is not None:
+        size = os.fstat(file.fileno()).st_size
+        return FileBodyResponse(file, size, result.media_type, headers, request)
+    return BufferResponse(result.body, result.media_type, headers, request)
 
 @app.post("/process-image/")
 async def process_image(
     request: Request,
     file: UploadFile = File(...), 
-    size: int = Form(100)
+    size: int = Form(100),
+    output: str = Form("jpeg"),
+    effort: Optional[str] = Form(None)
 ):
-    """Process image with size optimization"""
+    """Process image with size optimization.
+
+    output picks the encoder (see TARGET_OUTPUTS); "auto" chooses the
+    format that meets the size with the least loss. effort trades encode
+    time for size (see EFFORT_LEVELS).
+    """
     try:
         # Security validation
         if not validate_file(file):
@@ -170,21 +347,20 @@ async def process_image(
                 status_code=400, 
                 detail="Target size must be between 10 and 1000 KB."
             )
+        if output not in TARGET_OUTPUTS:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Unsupported output: {output}. Choose one of {', '.join(TARGET_OUTPUTS)}."
+            )
+        check_effort(effort)
         
-        img = Image.open(file.file)
-        processed_img = adjust_image(img, size)
+        data = await read_upload(file)
+        key, compute = resize_job(data, size, output, effort)
         
-        # Generate secure filename
-        safe_filename = f"processed_{hashlib.md5(file.filename.encode()).hexdigest()[:8]}.jpg"
+        # Generate secure filename; the extension follows the chosen format
+        safe_stem = f"processed_{hashlib.md5(file.filename.encode()).hexdigest()[:8]}"
         
-        return StreamingResponse(
-            processed_img, 
-            media_type="image/jpeg", 
-            headers={
-                "Content-Disposition": f"attachment; filename={safe_filename}",
-                "Cache-Control": "no-cache, no-store, must-revalidate"
-            }
-        )
+        return await run_cached(request, key, compute, safe_stem)
     except HTTPException:
         raise
     except Exception as e:
@@ -208,57 +384,20 @@ async def convert_image(
                 detail="Invalid file type or size. Please upload a valid image file (max 10MB)."
             )
         
-        img = Image.open(file.file)
-        
-        # Map user-friendly format to PIL format
-        format_map = {
-            'jpg': 'JPEG', 'jpeg': 'JPEG',
-            'png': 'PNG',
-            'gif': 'GIF',
-            'webp': 'WEBP',
-            'bmp': 'BMP',
-            'tiff': 'TIFF', 'tif': 'TIFF',
-        }
-        
-        fmt = format_map.get(format.lower())
+        fmt = FORMAT_MAP.get(format.lower())
         if not fmt:
             raise HTTPException(
                 status_code=400, 
                 detail=f"Unsupported format: {format}"
             )
         
-        # Convert mode if needed
-        if fmt in ['JPEG', 'BMP', 'WEBP'] and img.mode in ('RGBA', 'LA', 'P'):
-            img = img.convert('RGB')
-        
-        output_io = BytesIO()
-        img.save(output_io, format=fmt)
-        output_io.seek(0)
-        
-        # Set correct media type
-        media_types = {
-            'JPEG': 'image/jpeg',
-            'PNG': 'image/png',
-            'GIF': 'image/gif',
-            'WEBP': 'image/webp',
-            'BMP': 'image/bmp',
-            'TIFF': 'image/tiff',
-        }
-        
-        media_type = media_types.get(fmt, 'application/octet-stream')
-        ext = fmt.lower() if fmt != 'JPEG' else 'jpg'
+        data = await read_upload(file)
+        key, compute = convert_job(data, fmt)
         
         # Generate secure filename
-        safe_filename = f"converted_{hashlib.md5(file.filename.encode()).hexdigest()[:8]}.{ext}"
+        safe_stem = f"converted_{hashlib.md5(file.filename.encode()).hexdigest()[:8]}"
         
-        return StreamingResponse(
-            output_io, 
-            media_type=media_type, 
-            headers={
-                "Content-Disposition": f"attachment; filename={safe_filename}",
-                "Cache-Control": "no-cache, no-store, must-revalidate"
-            }
-        )
+        return await run_cached(request, key, compute, safe_stem)
     except HTTPException:
         raise
     except Exception as e:
@@ -267,10 +406,239 @@ async def convert_image(
             detail=f"Error converting image: {str(e)}"
         )
 
+@app.post("/batch/")
+async def batch_process(
+    request: Request,
+    files: List[UploadFile] = File(...),
+    size: Optional[int] = Form(None),
+    format: Optional[str] = Form(None),
+    params: Optional[str] = Form(None)
+):
+    """Process many images concurrently and stream the results as a ZIP.
+
+    Each file is resized to size KB or converted to format; params may give
+    a JSON array of per-file {"size": ...} or {"format": ...} overrides.
+    Results are added to the archive as they finish, followed by a
+    manifest.json with the status of every file.
+    """
+    if len(files) > Config.BATCH_MAX_FILES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Too many files. A batch may contain at most {Config.BATCH_MAX_FILES} images."
+        )
+    try:
+        specs = parse_batch_params(len(files), size, format, params)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    semaphore = asyncio.Semaphore(Config.BATCH_CONCURRENCY)
+
+    async def run_one(index: int, file: UploadFile, spec: dict):
+        entry = {"index": index, "filename": file.filename}
+        try:
+            if not validate_file(file):
+                raise HTTPException(
+                    status_code=400, 
+                    detail="Invalid file type or size. Please upload a valid image file (max 10MB)."
+                )
+            prefix, ext, make_job = resolve_operation(spec["size"], spec["format"])
+
+            async with semaphore:
+                data = await read_upload(file)
+                result, _ = await compute_cached(*make_job(data))
+            result = await result_cache.load(result)
+
+            name_hash = hashlib.md5((file.filename or "").encode()).hexdigest()[:8]
+            name = f"{index + 1:03d}_{prefix}_{name_hash}.{ext}"
+            entry.update(status="ok", output=name, bytes=len(result.body))
+            return entry, name, result.body
+        except HTTPException as e:
+            entry.update(status="error", status_code=e.status_code, error=e.detail)
+        except Exception as e:
+            entry.update(status="error", status_code=500, error=f"Error processing image: {str(e)}")
+        return entry, None, None
+
+    async def stream_archive():
+        archive = ZipStream()
+        tasks = [
+            asyncio.create_task(run_one(index, file, spec))
+            for index, (file, spec) in enumerate(zip(files, specs))
+        ]
+        manifest = []
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                entry, name, body = await next_done
+                manifest.append(entry)
+                if name:
+                    yield archive.add(name, body)
+            manifest.sort(key=lambda entry: entry["index"])
+            yield archive.add("manifest.json", json.dumps({"files": manifest}, indent=2).encode(), compress=True)
+            yield archive.close()
+        finally:
+            # Client went away or the stream failed: stop outstanding work
+            for task in tasks:
+                task.cancel()
+
+    return StreamingResponse(
+        stream_archive(),
+        media_type="application/zip",
+        headers={
+            "Content-Disposition": "attachment; filename=batch.zip",
+            "Cache-Control": "no-cache, no-store, must-revalidate"
+        }
+    )
+
+@app.post("/variants/")
+async def create_variants(
+    request: Request,
+    file: UploadFile = File(...),
+    widths: str = Form(...),
+    formats: str = Form("jpeg"),
+    max_kb: Optional[str] = Form(None),
+    effort: Optional[str] = Form(None)
+):
+    """Build a responsive image set (srcset) from one upload.
+
+    widths and formats are comma-separated; every width is produced in
+    every format (see ENCODERS). max_kb optionally caps each variant, as
+    one value or one per width. The image is decoded once and the variants
+    come back in a ZIP with a manifest.json.
+    """
+    try:
+        if not validate_file(file):
+            raise HTTPException(
+                status_code=400, 
+                detail="Invalid file type or size. Please upload a valid image file (max 10MB)."
+            )
+        try:
+            specs = parse_variant_params(widths, formats, max_kb)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        check_effort(effort)
+
+        data = await read_upload(file)
+        key, compute = variants_job(data, specs, effort)
+
+        safe_stem = f"variants_{hashlib.md5(file.filename.encode()).hexdigest()[:8]}"
+
+        return await run_cached(request, key, compute, safe_stem)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=500, 
+            detail=f"Error processing image: {str(e)}"
+        )
+
+def job_status(job: dict) -> dict:
+    """Public view of a job record"""
+    body = {
+        "job_id": job["job_id"],
+        "status": job["status"],
+        "created": job["created"],
+        "finished": job["finished"],
+        "status_url": f"/jobs/{job['job_id']}",
+    }
+    if job["status"] == DONE:
+        body["result_url"] = f"/jobs/{job['job_id']}/result"
+    elif job["status"] == FAILED:
+        body["error"] = job["error"]
+        body["error_status"] = job["error_status"]
+    return body
+
+@app.post("/jobs/")
+async def create_job(
+    request: Request,
+    file: UploadFile = File(...),
+    size: Optional[int] = Form(None),
+    format: Optional[str] = Form(None)
+):
+    """Queue an image for background resizing (size) or conversion (format).
+
+    Returns 202 with a job id to poll; 429 with Retry-After when the job
+    queue is full.
+    """
+    if not validate_file(file):
+        raise HTTPException(
+            status_code=400, 
+            detail="Invalid file type or size. Please upload a valid image file (max 10MB)."
+        )
+    if size is None and format is None:
+        raise HTTPException(status_code=400, detail="Either size or format is required.")
+    prefix, ext, make_job = resolve_operation(size, format)
+    data = await read_upload(file)
+    key, compute = make_job(data)
+
+    async def run() -> CachedResult:
+        # QueueFullError propagates so the job worker can wait and retry
+        try:
+            result, hit = await result_cache.get_or_compute(key, compute)
+        except (JobTimeoutError, WorkerCrashedError) as e:
+            raise run_in_worker_error(e)
+        CACHE_REQUESTS.inc("hit" if hit else "miss")
+        # The job store keeps the body, not a disk-tier path that may be evicted
+        return await result_cache.load(result)
+
+    safe_filename = f"{prefix}_{hashlib.md5(file.filename.encode()).hexdigest()[:8]}.{ext}"
+    try:
+        job_id = await job_manager.submit(run, safe_filename)
+    except QueueFullError:
+        raise HTTPException(
+            status_code=429,
+            detail="Job queue is full. Please try again later.",
+            headers={"Retry-After": str(Config.JOB_RETRY_AFTER)}
+        )
+
+    job = await job_manager.get(job_id)
+    return JSONResponse(status_code=202, content=job_status(job), headers={"Location": f"/jobs/{job_id}"})
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    """Report the status of a queued job"""
+    job = await job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found or expired.")
+    return job_status(job)
+
+@app.get("/jobs/{job_id}/result")
+async def get_job_result(request: Request, job_id: str):
+    """Download the output of a finished job; Range requests resume it"""
+    job = await job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found or expired.")
+    if job["status"] == FAILED:
+        raise HTTPException(status_code=job["error_status"], detail=job["error"])
+    if job["status"] != DONE:
+        raise HTTPException(
+            status_code=409,
+            detail="Job is not finished yet.",
+            headers={"Retry-After": "1"}
+        )
+
+    result = job["result"]
+    return BufferResponse(
+        result.body,
+        result.media_type,
+        {
+            "Content-Disposition": f"attachment; filename={job['filename']}",
+            "Cache-Control": "private, no-cache",
+            # A job's output never changes, so its id is a strong validator for If-Range
+            "ETag": f'"{job_id}"',
+            **result.headers
+        },
+        request
+    )
+
+if Config.METRICS_ENABLED:
+    @app.get("/metrics")
+    async def metrics():
+        """Prometheus-format counters, gauges and latency histograms"""
+        return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
 @app.get("/health")
 async def health_check():
     """Health check endpoint"""
     return {"status": "healthy", "timestamp": time.time()}
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=10000)
\ No newline at end of file
+    uvicorn.run(app, host="0.0.0.0", port=10000)
@@ -0,0 +1,199 @@
+from contextvars import ContextVar
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+import bisect
+import time
+
+# Latency buckets in seconds, from sub-millisecond stages to slow encodes
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def _format_labels(labelnames: Sequence[str], values: Tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(labelnames, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    """Monotonic counter with optional labels"""
+
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name, self.help, self.labelnames = name, help, tuple(labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, *labels: str, amount: float = 1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels: str) -> float:
+        return self._values.get(labels, 0)
+
+    def render(self) -> List[str]:
+        return [f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}"
+                for labels, value in sorted(self._values.items())]
+
+
+class Gauge(Counter):
+    """Value that goes up and down, or is read from a callback at scrape time"""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (),
+                 callback: Optional[Callable[[], float]] = None):
+        super().__init__(name, help, labelnames)
+        self._callback = callback
+
+    def dec(self, *labels: str, amount: float = 1):
+        self.inc(*labels, amount=-amount)
+
+    def render(self) -> List[str]:
+        if self._callback is not None:
+            return [f"{self.name} {_format_value(self._callback())}"]
+        return super().render()
+
+
+class Histogram:
+    """Cumulative-bucket histogram in the Prometheus text format"""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.name, self.help, self.labelnames = name, help, tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # labels -> [per-bucket counts (+Inf last), sum]
+        self._series: Dict[Tuple[str, ...], list] = {}
+
+    def observe(self, value: float, *labels: str):
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def count(self, *labels: str) -> int:
+        series = self._series.get(labels)
+        return sum(series[0]) if series else 0
+
+    def render(self) -> List[str]:
+        lines = []
+        for labels, (counts, total) in sorted(self._series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{bound:g}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labels)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, labels)} {cumulative}")
+        return lines
+
+
+class Registry:
+    """Collection of metrics rendered together for /metrics"""
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+REQUEST_SECONDS = registry.register(Histogram(
+    "http_request_duration_seconds", "Time to produce a response", ["path", "status"]))
+STAGE_SECONDS = registry.register(Histogram(
+    "image_stage_duration_seconds", "Time spent in each request stage", ["stage"]))
+ENCODE_SECONDS = registry.register(Histogram(
+    "image_encode_duration_seconds", "Time per full-resolution encode pass"))
+ENCODE_ITERATIONS = registry.register(Histogram(
+    "image_encode_iterations", "Full-resolution encodes per target-size request",
+    buckets=(1, 2, 3, 4, 5, 6, 8, 10, 15, 20)))
+CACHE_REQUESTS = registry.register(Counter(
+    "result_cache_requests_total", "Result cache lookups", ["result"]))
+REJECTIONS = registry.register(Counter(
+    "requests_rejected_total", "Requests refused before or during processing", ["reason"]))
+IN_FLIGHT = registry.register(Gauge(
+    "http_requests_in_flight", "Requests currently being handled"))
+
+
+class StageTimer:
+    """Per-request stage durations, reported as a Server-Timing header"""
+
+    def __init__(self):
+        self.stages: List[Tuple[str, float, str]] = []
+        self._last = time.perf_counter()
+
+    def lap(self, stage: str) -> float:
+        """Record the time since the previous lap as stage"""
+        now = time.perf_counter()
+        seconds = now - self._last
+        self._last = now
+        self.add(stage, seconds)
+        return seconds
+
+    def skip(self):
+        """Restart the lap clock without recording anything"""
+        self._last = time.perf_counter()
+
+    def add(self, stage: str, seconds: float, description: str = ""):
+        self.stages.append((stage, seconds, description))
+        STAGE_SECONDS.observe(seconds, stage)
+
+    def header(self) -> str:
+        entries = []
+        for stage, seconds, description in self.stages:
+            entry = f"{stage};dur={seconds * 1000:.1f}"
+            if description:
+                entry += f';desc="{description}"'
+            entries.append(entry)
+        return ", ".join(entries)
+
+
+_current_timer: ContextVar[Optional[StageTimer]] = ContextVar("stage_timer", default=None)
+
+
+def start_timer() -> StageTimer:
+    """Begin timing the current request"""
+    timer = StageTimer()
+    _current_timer.set(timer)
+    return timer
+
+
+def current_timer() -> StageTimer:
+    """The current request's timer, or a throwaway one outside a request"""
+    return _current_timer.get() or StageTimer()
+
+
+def record_worker_stats(stats: Dict, wall_seconds: float):
+    """Fold timings measured inside a worker into the request's timer.
+
+    wall_seconds is the time the request waited for the job; whatever the
+    worker did not account for was spent queued or in transfer.
+    """
+    timer = current_timer()
+    timer.add("queue", max(0.0, wall_seconds - stats.get("worker", 0.0)))
+    for stage, seconds in stats.get("stages", {}).items():
+        timer.add(stage, seconds)
+    encodes = stats.get("encodes", ())
+    for seconds in encodes:
+        ENCODE_SECONDS.observe(seconds)
+    if encodes:
+        timer.add("encode", sum(encodes), f"{len(encodes)} pass" + ("es" if len(encodes) != 1 else ""))
+    if "iterations" in stats:
+        ENCODE_ITERATIONS.observe(stats["iterations"])
+    timer.skip()
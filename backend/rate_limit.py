@@ -0,0 +1,163 @@
+from contextlib import contextmanager, nullcontext
+from typing import Dict, Optional, Tuple
+import hashlib
+import math
+import mmap
+import os
+import struct
+import time
+
+from config import Config
+
+# (window_start, current_count, previous_count)
+Slot = Tuple[float, int, int]
+
+
+class MemoryStore:
+    """Per-process slot storage in a dict"""
+
+    def __init__(self):
+        self._slots: Dict[str, Slot] = {}
+
+    def lock(self):
+        # Only touched from the event loop thread
+        return nullcontext()
+
+    def get(self, key: str) -> Optional[Slot]:
+        return self._slots.get(key)
+
+    def set(self, key: str, slot: Slot):
+        self._slots[key] = slot
+
+    def evict_idle(self, before: float):
+        """Drop clients whose last window started before the given time"""
+        idle = [key for key, slot in self._slots.items() if slot[0] < before]
+        for key in idle:
+            del self._slots[key]
+
+    def __len__(self) -> int:
+        return len(self._slots)
+
+
+class SharedFileStore:
+    """Fixed-size slot table in a memory-mapped file shared by processes.
+
+    Keys are hashed into an open-addressed table guarded by flock, so every
+    uvicorn worker pointing at the same file sees the same counters. Idle
+    slots are reused in place, which bounds memory at slots * 24 bytes.
+    """
+
+    _SLOT = struct.Struct("<QdII")  # key hash, window_start, current, previous
+    _PROBES = 16
+
+    def __init__(self, path: str, slots: int):
+        import fcntl  # Unix only; imported here so the memory store works anywhere
+        self._fcntl = fcntl
+        self.slots = slots
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        size = slots * self._SLOT.size
+        if os.fstat(self._fd).st_size != size:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                if os.fstat(self._fd).st_size != size:
+                    os.ftruncate(self._fd, size)
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+        self._map = mmap.mmap(self._fd, size)
+        # Reusable-slot threshold, set by evict_idle
+        self._stale_before = 0.0
+
+    @contextmanager
+    def lock(self):
+        self._fcntl.flock(self._fd, self._fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            self._fcntl.flock(self._fd, self._fcntl.LOCK_UN)
+
+    def _hash(self, key: str) -> int:
+        return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "little") or 1
+
+    def _find(self, key_hash: int) -> Tuple[int, bool]:
+        """Return (index, found) for key_hash, or the slot to claim for it"""
+        start = key_hash % self.slots
+        claim = None
+        oldest = None
+        for probe in range(self._PROBES):
+            index = (start + probe) % self.slots
+            slot_hash, window_start, _, _ = self._SLOT.unpack_from(self._map, index * self._SLOT.size)
+            if slot_hash == key_hash:
+                return index, True
+            if claim is None and (slot_hash == 0 or window_start < self._stale_before):
+                claim = index
+            if oldest is None or window_start < oldest[1]:
+                oldest = (index, window_start)
+        # Table crowded: take over the least recently started window
+        return (claim if claim is not None else oldest[0]), False
+
+    def get(self, key: str) -> Optional[Slot]:
+        index, found = self._find(self._hash(key))
+        if not found:
+            return None
+        _, window_start, current, previous = self._SLOT.unpack_from(self._map, index * self._SLOT.size)
+        return window_start, current, previous
+
+    def set(self, key: str, slot: Slot):
+        key_hash = self._hash(key)
+        index, _ = self._find(key_hash)
+        self._SLOT.pack_into(self._map, index * self._SLOT.size, key_hash, *slot)
+
+    def evict_idle(self, before: float):
+        """Mark slots whose last window started before the given time reusable"""
+        self._stale_before = before
+
+    def close(self):
+        self._map.close()
+        os.close(self._fd)
+
+
+class RateLimiter:
+    """Sliding-window counter: O(1) time and memory per client.
+
+    Each client keeps request counts for the current and previous fixed
+    window; the previous count is weighted by how much of it still overlaps
+    the sliding window.
+    """
+
+    def __init__(self, store=None, window: Optional[float] = None, limit: Optional[int] = None):
+        self.store = store if store is not None else create_store()
+        self.window = window or Config.RATE_LIMIT_WINDOW
+        self.limit = limit or Config.RATE_LIMIT_MAX_REQUESTS
+        self._last_sweep = 0.0
+
+    def check(self, key: str, now: Optional[float] = None) -> Tuple[bool, int]:
+        """Count a request; return (allowed, retry_after_seconds)"""
+        now = time.time() if now is None else now
+        with self.store.lock():
+            if now - self._last_sweep > self.window:
+                self.store.evict_idle(now - 2 * self.window)
+                self._last_sweep = now
+
+            window_start, current, previous = self.store.get(key) or (now, 0, 0)
+            elapsed = now - window_start
+            if elapsed >= 2 * self.window:
+                window_start, current, previous = now, 0, 0
+            elif elapsed >= self.window:
+                window_start, current, previous = window_start + self.window, 0, current
+                elapsed -= self.window
+
+            estimated = previous * (1 - elapsed / self.window) + current
+            allowed = estimated < self.limit
+            if allowed:
+                current += 1
+            self.store.set(key, (window_start, current, previous))
+
+        retry_after = 0 if allowed else max(1, math.ceil(window_start + self.window - now))
+        return allowed, retry_after
+
+
+def create_store():
+    """Build the slot store selected by RATE_LIMIT_BACKEND"""
+    if Config.RATE_LIMIT_BACKEND == "file":
+        return SharedFileStore(Config.RATE_LIMIT_FILE, Config.RATE_LIMIT_SLOTS)
+    return MemoryStore()
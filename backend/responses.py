@@ -0,0 +1,125 @@
+from fastapi import Request
+from fastapi.responses import Response
+from starlette.types import Receive, Scope, Send
+from typing import BinaryIO, Dict, Optional, Tuple
+import asyncio
+
+# Read size when sending a file body, as in Starlette's FileResponse
+CHUNK_SIZE = 64 * 1024
+
+
+class RangeNotSatisfiable(Exception):
+    """The requested range starts beyond the end of the body"""
+
+
+def parse_range(value: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """The single byte range named by a Range header, as (start, end).
+
+    end is exclusive. Returns None when the whole body should be sent:
+    no header, another unit, a malformed value or several ranges, which a
+    server may ignore. Raises RangeNotSatisfiable when no byte of the body
+    is in range.
+    """
+    if not value:
+        return None
+    unit, _, spec = value.partition("=")
+    first, dash, last = spec.strip().partition("-")
+    if unit.strip().lower() != "bytes" or not dash or "," in spec:
+        return None
+    if not first:
+        # Suffix range: the last N bytes
+        if not last.isdigit():
+            return None
+        if int(last) == 0 or size == 0:
+            raise RangeNotSatisfiable()
+        return max(0, size - int(last)), size
+    if not first.isdigit() or (last and not last.isdigit()):
+        return None
+    start = int(first)
+    if last and int(last) < start:
+        return None
+    if start >= size:
+        raise RangeNotSatisfiable()
+    return start, min(int(last) + 1 if last else size, size)
+
+
+def _resolve_range(
+    request: Optional[Request], size: int, headers: Dict[str, str]
+) -> Tuple[int, Optional[Tuple[int, int]], Dict[str, str]]:
+    """Pick the status, byte span and headers for a body of size bytes.
+
+    Ranges are only honoured on GET and HEAD, and only while If-Range
+    (if sent) names the response's current ETag.
+    """
+    headers = {**headers, "Accept-Ranges": "bytes"}
+    if request is None or request.method not in ("GET", "HEAD"):
+        return 200, None, headers
+    if_range = request.headers.get("If-Range")
+    if if_range is not None and if_range != headers.get("ETag"):
+        return 200, None, headers
+    try:
+        span = parse_range(request.headers.get("Range"), size)
+    except RangeNotSatisfiable:
+        headers["Content-Range"] = f"bytes */{size}"
+        return 416, (0, 0), headers
+    if span is None:
+        return 200, None, headers
+    headers["Content-Range"] = f"bytes {span[0]}-{span[1] - 1}/{size}"
+    return 206, span, headers
+
+
+class BufferResponse(Response):
+    """An encoded body sent as one memoryview with an exact Content-Length.
+
+    A Range request gets a zero-copy slice of the buffer. The view is
+    dropped once sent, so the buffer is freed as soon as nothing else
+    (e.g. the result cache) holds it.
+    """
+
+    def __init__(self, body: bytes, media_type: str, headers: Dict[str, str],
+                 request: Optional[Request] = None):
+        view = memoryview(body)
+        status, span, headers = _resolve_range(request, len(view), headers)
+        if span is not None:
+            view = view[span[0]:span[1]]
+        super().__init__(view, status_code=status, headers=headers,
+                         media_type=media_type if status != 416 else None)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self.body = b""
+
+
+class FileBodyResponse(Response):
+    """An open file sent in CHUNK_SIZE pieces with an exact Content-Length.
+
+    Used for large disk-tier cache hits. Reads run in a thread, and the
+    file is closed when the send completes or fails.
+    """
+
+    def __init__(self, file: BinaryIO, size: int, media_type: str, headers: Dict[str, str],
+                 request: Optional[Request] = None):
+        status, span, headers = _resolve_range(request, size, headers)
+        self.file = file
+        self.span = span or (0, size)
+        headers["Content-Length"] = str(self.span[1] - self.span[0])
+        super().__init__(None, status_code=status, headers=headers,
+                         media_type=media_type if status != 416 else None)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        try:
+            await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+            start, end = self.span
+            remaining = end - start
+            if remaining:
+                await asyncio.to_thread(self.file.seek, start)
+            more_body = True
+            while more_body:
+                chunk = await asyncio.to_thread(self.file.read, min(CHUNK_SIZE, remaining)) if remaining else b""
+                remaining -= len(chunk)
+                more_body = remaining > 0 and bool(chunk)
+                await send({"type": "http.response.body", "body": chunk, "more_body": more_body})
+        finally:
+            await asyncio.to_thread(self.file.close)
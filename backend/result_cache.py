@@ -0,0 +1,230 @@
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, NamedTuple, Optional, Tuple
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import tempfile
+
+from config import Config
+
+# Bump when pipeline changes alter the output for the same inputs
+_KEY_VERSION = b"1"
+
+logger = logging.getLogger(__name__)
+
+
+class CachedResult(NamedTuple):
+    """An encoded response body and what is needed to serve it again.
+
+    Large disk-tier hits leave body empty and set path to the cached file,
+    so they can be sent without reading it into memory (see load()).
+    """
+    body: bytes
+    media_type: str
+    headers: Dict[str, str]
+    path: Optional[str] = None
+
+
+def cache_key(data: bytes, operation: str, param) -> str:
+    """Content address for an (input bytes, operation, parameter) triple"""
+    digest = hashlib.sha256(data)
+    digest.update(b"\0" + _KEY_VERSION + b"\0" + f"{operation}:{param}".encode())
+    return digest.hexdigest()
+
+
+def make_etag(key: str) -> str:
+    """Strong ETag for a cache key (outputs are deterministic per key)"""
+    return f'"{key[:32]}"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Check an If-None-Match header value against an ETag"""
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*" or candidate.removeprefix("W/") == etag:
+            return True
+    return False
+
+
+class ResultCache:
+    """Byte-budgeted LRU of encoded results with an optional disk tier.
+
+    Concurrent requests for the same key share one computation. The disk
+    tier is only used when a directory is configured; its files are
+    evicted oldest-first once CACHE_DISK_MAX_BYTES is exceeded.
+    """
+
+    def __init__(
+        self,
+        max_bytes: Optional[int] = None,
+        disk_dir: Optional[str] = None,
+        disk_max_bytes: Optional[int] = None,
+    ):
+        self.max_bytes = Config.CACHE_MAX_BYTES if max_bytes is None else max_bytes
+        self.disk_dir = disk_dir if disk_dir is not None else Config.CACHE_DIR
+        self.disk_max_bytes = Config.CACHE_DISK_MAX_BYTES if disk_max_bytes is None else disk_max_bytes
+        self._entries: "OrderedDict[str, CachedResult]" = OrderedDict()
+        self._bytes = 0
+        self._inflight: Dict[str, asyncio.Task] = {}
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+
+    @property
+    def size_bytes(self) -> int:
+        return self._bytes
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: str) -> Optional[CachedResult]:
+        """Look up the memory tier, refreshing the entry's recency"""
+        result = self._entries.get(key)
+        if result is not None:
+            self._entries.move_to_end(key)
+        return result
+
+    def put(self, key: str, result: CachedResult):
+        """Store in the memory tier, evicting least recently used entries"""
+        size = len(result.body)
+        if size > self.max_bytes or result.path is not None:
+            return
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._bytes -= len(old.body)
+        self._entries[key] = result
+        self._bytes += size
+        while self._bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= len(evicted.body)
+
+    async def get_or_compute(
+        self, key: str, compute: Callable[[], Awaitable[CachedResult]]
+    ) -> Tuple[CachedResult, bool]:
+        """Return (result, hit), computing at most once per key at a time.
+
+        The lookup and computation run in their own task, so a cancelled
+        caller only stops its own wait: requests that joined the same
+        computation still get the result, and it is still cached.
+        """
+        result = self.get(key)
+        if result is not None:
+            return result, True
+
+        task = self._inflight.get(key)
+        joined = task is not None
+        if task is None:
+            task = asyncio.create_task(self._fill(key, compute))
+            self._inflight[key] = task
+            task.add_done_callback(lambda done: self._fill_done(key, done))
+        result, hit = await asyncio.shield(task)
+        return result, hit or joined
+
+    async def _fill(
+        self, key: str, compute: Callable[[], Awaitable[CachedResult]]
+    ) -> Tuple[CachedResult, bool]:
+        result = None
+        if self.disk_dir:
+            result = await asyncio.to_thread(self._disk_read, key)
+        hit = result is not None
+        if not hit:
+            result = await compute()
+            if self.disk_dir:
+                try:
+                    await asyncio.to_thread(self._disk_write, key, result)
+                except OSError:
+                    # The result is still good; it just is not on disk
+                    logger.exception("Writing result %s to the disk cache failed", key)
+        self.put(key, result)
+        return result, hit
+
+    def _fill_done(self, key: str, task: asyncio.Task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        # Mark retrieved so an exception nobody waited on is not logged
+        if not task.cancelled():
+            task.exception()
+
+    async def load(self, result: CachedResult) -> CachedResult:
+        """result with its body in memory, reading it from disk if needed"""
+        if result.path is None:
+            return result
+        body = await asyncio.to_thread(_read_file, result.path)
+        return result._replace(body=body, path=None)
+
+    # Disk tier: <key>.bin holds the body, <key>.json the media type and headers
+
+    def _disk_path(self, key: str, suffix: str) -> str:
+        return os.path.join(self.disk_dir, f"{key}.{suffix}")
+
+    def _disk_read(self, key: str) -> Optional[CachedResult]:
+        try:
+            with open(self._disk_path(key, "json")) as f:
+                meta = json.load(f)
+            body_path = self._disk_path(key, "bin")
+            if os.path.getsize(body_path) >= Config.CACHE_DISK_STREAM_BYTES:
+                # Served straight from the file; not worth holding in memory
+                body, path = b"", body_path
+            else:
+                body, path = _read_file(body_path), None
+            os.utime(body_path)
+        except (OSError, ValueError):
+            # Missing, half-written or evicted by another worker meanwhile
+            return None
+        return CachedResult(body, meta["media_type"], meta["headers"], path)
+
+    def _disk_write(self, key: str, result: CachedResult):
+        if len(result.body) > self.disk_max_bytes:
+            return
+        # Write the body first and publish the metadata last, atomically
+        self._disk_replace(self._disk_path(key, "bin"), result.body)
+        meta = {"media_type": result.media_type, "headers": result.headers}
+        self._disk_replace(self._disk_path(key, "json"), json.dumps(meta).encode())
+        self._disk_evict()
+
+    def _disk_replace(self, path: str, data: bytes):
+        # A unique temp file: workers sharing CACHE_DIR may write one key at once
+        fd, tmp_path = tempfile.mkstemp(dir=self.disk_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+
+    def _disk_evict(self):
+        bodies = []
+        total = 0
+        for entry in os.scandir(self.disk_dir):
+            if entry.name.endswith(".bin"):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue  # evicted by another worker
+                bodies.append((stat.st_mtime, stat.st_size, entry.name[:-4]))
+                total += stat.st_size
+        bodies.sort()
+        for _, size, key in bodies:
+            if total <= self.disk_max_bytes:
+                break
+            for suffix in ("json", "bin"):
+                try:
+                    os.remove(self._disk_path(key, suffix))
+                except OSError:
+                    pass
+            total -= size
+
+
+def _read_file(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+
+result_cache = ResultCache()
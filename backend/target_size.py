@@ -0,0 +1,399 @@
+from PIL import Image, ImageChops, ImageStat
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from typing import Callable, Dict, NamedTuple, Optional, Tuple
+import math
+import time
+
+from config import Config
+
+
+# Typical d(log size)/d(quality) for JPEG, used until two points are measured
+_DEFAULT_SLOPE = 0.05
+
+# Floor for measured slopes, so a flat or noisy pair cannot stall the search
+_MIN_SLOPE = 0.002
+
+
+class TargetSizeResult(NamedTuple):
+    """Outcome of a target-size search"""
+    buffer: BytesIO
+    size_kb: float
+    quality: int
+    scale: float
+    iterations: int        # full-resolution encodes
+    proxy_encodes: int
+    encode_seconds: Tuple[float, ...] = ()  # duration of each full-resolution encode
+    encoder: str = "jpeg"
+
+
+# Encoder effort: "fast" skips optional passes (Huffman optimization, slow
+# WebP methods, PNG deflate search), "best" enables all of them
+EFFORT_LEVELS = ('fast', 'balanced', 'best')
+
+# Quality-search candidates tried by the "auto" output mode, in order of
+# preference when their predicted fidelity is equal
+AUTO_CANDIDATES = ('jpeg', 'webp', 'png8', 'jpeg-progressive', 'webp-lossless')
+
+# Candidates within this many dB PSNR of the best count as equal
+_AUTO_PSNR_MARGIN = 0.5
+
+
+class Encoder(NamedTuple):
+    """An output format the target-size search can drive"""
+    name: str
+    format: str  # PIL format
+    encode: Callable[[Image.Image, int, str], bytes]  # (rgb image, quality, effort) -> bytes
+    searchable: bool  # whether quality changes the size; if not, only scale does
+
+
+def _save(img: Image.Image, format: str, **params) -> bytes:
+    output_io = BytesIO()
+    img.save(output_io, format=format, **params)
+    return output_io.getvalue()
+
+
+def _encode_jpeg(img: Image.Image, quality: int, effort: str = 'balanced', progressive: bool = False) -> bytes:
+    """Encode an RGB image to JPEG bytes"""
+    return _save(img, "JPEG", quality=quality, optimize=effort != 'fast', progressive=progressive)
+
+
+def _encode_webp(img: Image.Image, quality: int, effort: str = 'balanced') -> bytes:
+    return _save(img, "WEBP", quality=quality, method={'fast': 0, 'balanced': 4, 'best': 6}[effort])
+
+
+def _encode_webp_lossless(img: Image.Image, quality: int, effort: str = 'balanced') -> bytes:
+    # In lossless mode quality is compression effort, not fidelity
+    method, effort_quality = {'fast': (0, 25), 'balanced': (4, 75), 'best': (6, 90)}[effort]
+    return _save(img, "WEBP", lossless=True, quality=effort_quality, method=method)
+
+
+def _encode_png8(img: Image.Image, quality: int, effort: str = 'balanced') -> bytes:
+    """256-colour palette PNG; suits flat graphics and screenshots"""
+    method = Image.Quantize.FASTOCTREE if effort == 'fast' else Image.Quantize.MEDIANCUT
+    indexed = img.quantize(256, method=method)
+    # quantize() copies info; an RGB transparency tuple is invalid for P
+    indexed.info.pop('transparency', None)
+    if effort == 'best':
+        return _save(indexed, "PNG", optimize=True)
+    return _save(indexed, "PNG", compress_level=1 if effort == 'fast' else 6)
+
+
+ENCODERS = {
+    'jpeg': Encoder('jpeg', 'JPEG', _encode_jpeg, True),
+    'jpeg-progressive': Encoder(
+        'jpeg-progressive', 'JPEG',
+        lambda img, quality, effort: _encode_jpeg(img, quality, effort, progressive=True), True),
+    'webp': Encoder('webp', 'WEBP', _encode_webp, True),
+    'webp-lossless': Encoder('webp-lossless', 'WEBP', _encode_webp_lossless, False),
+    'png8': Encoder('png8', 'PNG', _encode_png8, False),
+}
+
+
+def _scaled_size(img: Image.Image, scale: float) -> Tuple[int, int]:
+    width, height = img.size
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def _scaled(img: Image.Image, scale: float) -> Image.Image:
+    """Return img resized by scale (never below 1x1)"""
+    if scale == 1.0:
+        return img
+    return img.resize(_scaled_size(img, scale), Image.LANCZOS)
+
+
+def _max_scale(img: Image.Image) -> float:
+    """Largest scale that keeps the output within MAX_IMAGE_DIMENSIONS"""
+    max_w, max_h = Config.MAX_IMAGE_DIMENSIONS
+    width, height = img.size
+    return max(1.0, min(max_w / width, max_h / height))
+
+
+def _clamp_scale(img: Image.Image, scale: float, upscale: bool = True) -> float:
+    """Keep scale between a 1px edge and MAX_IMAGE_DIMENSIONS (or 1.0)"""
+    min_scale = 1.0 / min(img.size)
+    return min(max(scale, min_scale), _max_scale(img) if upscale else 1.0)
+
+
+def _proxy(img: Image.Image) -> Image.Image:
+    proxy = img.copy()
+    proxy.thumbnail((Config.TARGET_SIZE_PROXY_EDGE, Config.TARGET_SIZE_PROXY_EDGE), Image.BILINEAR)
+    return proxy
+
+
+def estimate_start(
+    img: Image.Image,
+    target_kb: float,
+    full_size: Optional[Tuple[int, int]] = None,
+    encoder: Optional[Encoder] = None,
+    proxy: Optional[Image.Image] = None,
+) -> Tuple[float, int, int]:
+    """Estimate (scale, quality) for a target size from a downsampled proxy.
+
+    Encoded size grows roughly linearly with pixel count, so the bytes per
+    pixel of a small proxy encode predict the full-resolution size. The
+    proxy is denser than the original, so the estimate errs on the large
+    side. img may itself be a reduced rendition of an image of full_size;
+    the returned scale is relative to full_size (default img.size).
+    encoder defaults to JPEG; proxy may be passed in to share it across
+    calls. Returns (scale, quality, proxy_encodes).
+    """
+    encoder = encoder or ENCODERS['jpeg']
+    full_width, full_height = full_size or img.size
+    proxy = proxy or _proxy(img)
+    pixel_ratio = (full_width * full_height) / (proxy.width * proxy.height)
+    target_bytes = target_kb * 1024
+    proxy_encodes = 0
+
+    def predicted(quality: int) -> float:
+        nonlocal proxy_encodes
+        proxy_encodes += 1
+        return len(encoder.encode(proxy, quality, 'fast')) * pixel_ratio
+
+    if not encoder.searchable:
+        # Lossless output gains nothing from being upscaled to fill the target
+        size = predicted(Config.MAX_QUALITY)
+        return min(1.0, math.sqrt(target_bytes / size)), Config.MAX_QUALITY, proxy_encodes
+
+    # Smallest achievable size at full resolution decides whether we must scale
+    at_min = predicted(Config.MIN_QUALITY)
+    if at_min > target_bytes:
+        return math.sqrt(target_bytes / at_min), Config.MIN_QUALITY, proxy_encodes
+
+    at_max = predicted(Config.MAX_QUALITY)
+    if at_max < target_bytes:
+        return math.sqrt(target_bytes / at_max), Config.MAX_QUALITY, proxy_encodes
+
+    # Binary search the proxy for the quality that lands on the target
+    lo, hi = Config.MIN_QUALITY, Config.MAX_QUALITY
+    while hi - lo > 2:
+        mid = (lo + hi) // 2
+        if predicted(mid) > target_bytes:
+            hi = mid
+        else:
+            lo = mid
+    return 1.0, lo, proxy_encodes
+
+
+def _slope(a: Tuple[int, float], b: Tuple[int, float]) -> float:
+    """d(log size)/d(quality) between two (quality, size_kb) encodes"""
+    return max(math.log(b[1] / a[1]) / (b[0] - a[0]), _MIN_SLOPE)
+
+
+def _psnr(reference: Image.Image, candidate: Image.Image) -> float:
+    """Peak signal-to-noise ratio in dB (capped at 100 for identical images)"""
+    rms = ImageStat.Stat(ImageChops.difference(reference, candidate)).rms
+    mse = sum(value * value for value in rms) / len(rms)
+    return 100.0 if mse == 0 else min(100.0, 10 * math.log10(255 * 255 / mse))
+
+
+def estimate_candidates(
+    img: Image.Image,
+    target_kb: float,
+    full_size: Optional[Tuple[int, int]] = None,
+    candidates: Tuple[str, ...] = AUTO_CANDIDATES,
+) -> Dict[str, Tuple[float, int]]:
+    """estimate_start for each candidate encoder, sharing one proxy.
+
+    Candidates run in parallel threads (Pillow releases the GIL while
+    encoding). Returns {name: (scale, quality)}.
+    """
+    proxy = _proxy(img)
+
+    # Each thread gets its own copy: save() stores encoder options on the image
+    def estimate(name: str) -> Tuple[float, int]:
+        scale, quality, _ = estimate_start(img, target_kb, full_size, ENCODERS[name], proxy.copy())
+        return scale, quality
+
+    with ThreadPoolExecutor(max_workers=len(candidates)) as pool:
+        return dict(zip(candidates, pool.map(estimate, candidates)))
+
+
+def _sample_tiles(img: Image.Image) -> Image.Image:
+    """Mosaic of four native-resolution tiles from across img.
+
+    Unlike a downsampled proxy this shows what a lower output scale
+    loses, while costing no more to encode.
+    """
+    tile_w = min(Config.TARGET_SIZE_PROXY_EDGE // 2, max(1, img.width // 2))
+    tile_h = min(Config.TARGET_SIZE_PROXY_EDGE // 2, max(1, img.height // 2))
+    mosaic = Image.new('RGB', (tile_w * 2, tile_h * 2))
+    for index, (fx, fy) in enumerate(((0.25, 0.25), (0.75, 0.25), (0.25, 0.75), (0.75, 0.75))):
+        left = min(max(0, round(img.width * fx - tile_w / 2)), img.width - tile_w)
+        top = min(max(0, round(img.height * fy - tile_h / 2)), img.height - tile_h)
+        tile = img.crop((left, top, left + tile_w, top + tile_h))
+        mosaic.paste(tile, ((index % 2) * tile_w, (index // 2) * tile_h))
+    return mosaic
+
+
+def pick_encoder(img: Image.Image, estimates: Dict[str, Tuple[float, int]]) -> str:
+    """Name of the estimate that keeps the most fidelity.
+
+    Native-resolution tiles of img are encoded at each estimate's
+    (scale, quality), with scale relative to img, restored to size and
+    scored by PSNR, so resolution loss counts like compression loss.
+    Scores within _AUTO_PSNR_MARGIN of the best tie, and ties go to the
+    earliest estimate.
+    """
+    tiles = _sample_tiles(img)
+
+    def score(name: str) -> float:
+        scale, quality = estimates[name]
+        small = _scaled(tiles.copy(), min(1.0, scale))
+        with Image.open(BytesIO(ENCODERS[name].encode(small, quality, 'fast'))) as decoded:
+            restored = decoded.convert('RGB').resize(tiles.size, Image.BICUBIC)
+        return _psnr(tiles, restored)
+
+    with ThreadPoolExecutor(max_workers=len(estimates)) as pool:
+        scores = dict(zip(estimates, pool.map(score, estimates)))
+    best = max(scores.values())
+    return next(name for name, psnr in scores.items() if psnr >= best - _AUTO_PSNR_MARGIN)
+
+
+def encode_to_target_size(
+    img: Image.Image,
+    target_kb: float,
+    tolerance_kb: Optional[float] = None,
+    max_encodes: Optional[int] = None,
+    start: Optional[Tuple[float, int]] = None,
+    encoder: Optional[Encoder] = None,
+    effort: Optional[str] = None,
+    rescale: bool = True,
+) -> TargetSizeResult:
+    """Encode an RGB image as close to target_kb as possible.
+
+    Quality is searched at a fixed scale with secant steps on log(size),
+    which is close to linear in quality: through the closest encodes on
+    either side of the target once it is bracketed, through the last two
+    encodes before that; a step past the range probes its bound first.
+    When the range is exhausted the scale is corrected from the measured
+    size (file size tracks pixel count) and only the scale is searched from
+    then on, at the closest quality so far. If the corrected scale gives
+    the same pixel size (it is at a bound, or the correction rounds away),
+    quality is searched again at that scale instead. The scale exponent is
+    learned from the first encode after each rescale.
+    The number of full-resolution encodes is capped by max_encodes; the
+    closest result at or under target + tolerance is returned. start is a
+    precomputed (scale, quality) estimate that skips the proxy encodes.
+    encoder defaults to JPEG; for encoders whose size does not depend on
+    quality only the scale is searched. effort is one of EFFORT_LEVELS
+    (default ENCODER_EFFORT). With rescale=False the start scale is kept
+    and only quality is searched.
+    """
+    encoder = encoder or ENCODERS['jpeg']
+    effort = effort or Config.ENCODER_EFFORT
+    if tolerance_kb is None:
+        tolerance_kb = Config.TARGET_SIZE_TOLERANCE_KB
+    if max_encodes is None:
+        max_encodes = Config.TARGET_SIZE_MAX_ENCODES
+
+    if start is None:
+        scale, quality, proxy_encodes = estimate_start(img, target_kb, encoder=encoder)
+    else:
+        (scale, quality), proxy_encodes = start, 0
+    scale = _clamp_scale(img, scale, encoder.searchable)
+    if encoder.searchable:
+        lo, hi = Config.MIN_QUALITY, Config.MAX_QUALITY
+    else:
+        # A single quality: every miss goes straight to a scale correction
+        lo = hi = quality
+    # Closest (quality, size_kb) measured under and over the target at the
+    # current scale, and the encode before the latest one
+    under = over = latest = None
+    # Size grows as scale ** exponent; refined from the first encode after
+    # each rescale, which repeats the reference quality
+    exponent = 2.0
+    # Whether the whole quality range has been open at the current scale
+    full_range = True
+    rescaled_from = None  # (previous scale, reference size_kb)
+    best = None  # (data, size_kb, quality, scale)
+    iterations = 0
+    encode_seconds = []
+    scaled_img = _scaled(img, scale)
+
+    def better(candidate, current) -> bool:
+        if current is None:
+            return True
+        limit = target_kb + tolerance_kb
+        cand_fits, cur_fits = candidate[1] <= limit, current[1] <= limit
+        if cand_fits != cur_fits:
+            return cand_fits
+        if cand_fits:
+            return abs(candidate[1] - target_kb) < abs(current[1] - target_kb)
+        return candidate[1] < current[1]
+
+    while iterations < max_encodes:
+        started = time.perf_counter()
+        data = encoder.encode(scaled_img, quality, effort)
+        encode_seconds.append(time.perf_counter() - started)
+        iterations += 1
+        size_kb = len(data) / 1024
+        candidate = (data, size_kb, quality, scale)
+        if better(candidate, best):
+            best = candidate
+
+        if abs(size_kb - target_kb) <= tolerance_kb:
+            break
+
+        if rescaled_from:
+            old_scale, ref_kb = rescaled_from
+            exponent = min(max(math.log(size_kb / ref_kb) / math.log(scale / old_scale), 1.0), 4.0)
+            rescaled_from = None
+
+        if size_kb > target_kb:
+            over, hi = (quality, size_kb), quality - 1
+        else:
+            under, lo = (quality, size_kb), quality + 1
+        earlier, latest = latest, (quality, size_kb)
+
+        if lo <= hi:
+            # Secant step on log(size) vs quality, kept inside the bracket
+            if under and over:
+                ref, slope = under, _slope(under, over)
+            elif earlier is not None:
+                # Same side twice: the curve flattens as quality rises, so
+                # the last two encodes predict better than a fixed slope
+                ref, slope = latest, _slope(earlier, latest)
+            else:
+                ref, slope = latest, _DEFAULT_SLOPE
+            wanted = ref[0] + math.log(target_kb / ref[1]) / slope
+            # Clamping probes MIN/MAX_QUALITY before any rescale, since an
+            # extrapolated slope often underestimates how far quality reaches
+            quality = min(max(round(wanted), lo), hi)
+            continue
+
+        # Quality cannot reach the target at this scale: correct the scale
+        # from the encode closest to the target and search scale only.
+        if not rescale:
+            break
+        ref_quality, ref_kb = under or over
+        new_scale = _clamp_scale(img, scale * (target_kb / ref_kb) ** (1 / exponent), encoder.searchable)
+        if _scaled_size(img, new_scale) == scaled_img.size:
+            # The scale cannot move, so reopen quality on the target's side
+            # of the latest encode, once per scale
+            if full_range or not encoder.searchable:
+                break
+            full_range = True
+            if over:
+                lo, hi = Config.MIN_QUALITY, quality - 1
+            else:
+                lo, hi = quality + 1, Config.MAX_QUALITY
+            if lo > hi:
+                break
+            earlier = None
+            quality = min(max(round(quality + math.log(target_kb / size_kb) / _DEFAULT_SLOPE), lo), hi)
+            continue
+        rescaled_from = (scale, ref_kb)
+        scale = new_scale
+        scaled_img = _scaled(img, scale)
+        # Size moves smoothly with scale but in coarse steps with quality,
+        # so the quality is settled and only the scale is searched further
+        quality = ref_quality
+        lo = hi = quality
+        under = over = latest = None
+        full_range = False
+
+    data, size_kb, quality, scale = best
+    return TargetSizeResult(
+        BytesIO(data), size_kb, quality, scale, iterations, proxy_encodes, tuple(encode_seconds), encoder.name
+    )
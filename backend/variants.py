@@ -0,0 +1,199 @@
+from PIL import Image
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from typing import Dict, List, Optional, Tuple
+import json
+import math
+import os
+import time
+
+from batch import ZipStream
+from config import Config
+from target_size import ENCODERS, encode_to_target_size, estimate_start
+
+# File extension for each variant encoder's output
+_EXTENSIONS = {'JPEG': 'jpg', 'WEBP': 'webp', 'PNG': 'png'}
+
+
+def _parse_list(value: str, name: str) -> List[str]:
+    items = [item.strip() for item in value.split(",") if item.strip()]
+    if not items:
+        raise ValueError(f"{name} must be a comma-separated list")
+    return items
+
+
+def parse_variant_params(widths: str, formats: str, max_kb: Optional[str]) -> List[Dict]:
+    """Resolve the variants requested for one image.
+
+    widths and formats are comma-separated lists; every width is produced
+    in every format. max_kb is an optional KB budget, either one value for
+    all variants or one per width in the order given. Returns specs
+    sorted by descending width. Raises ValueError for malformed input.
+    """
+    try:
+        width_list = [int(width) for width in _parse_list(widths, "widths")]
+    except ValueError:
+        raise ValueError("widths must be a comma-separated list of integers")
+    max_width = Config.MAX_IMAGE_DIMENSIONS[0]
+    if not all(Config.VARIANT_MIN_WIDTH <= width <= max_width for width in width_list):
+        raise ValueError(f"Widths must be between {Config.VARIANT_MIN_WIDTH} and {max_width} pixels.")
+
+    format_list = list(dict.fromkeys(fmt.lower() for fmt in _parse_list(formats, "formats")))
+    unknown = [fmt for fmt in format_list if fmt not in ENCODERS]
+    if unknown:
+        raise ValueError(f"Unsupported format: {unknown[0]}. Choose from {', '.join(ENCODERS)}.")
+    extensions = [_EXTENSIONS[ENCODERS[fmt].format] for fmt in format_list]
+    if len(set(extensions)) != len(extensions):
+        raise ValueError("Formats must produce distinct file types.")
+
+    budgets = [None] * len(width_list)
+    if max_kb:
+        try:
+            values = [float(value) for value in _parse_list(max_kb, "max_kb")]
+        except ValueError:
+            raise ValueError("max_kb must be a number or a comma-separated list of numbers")
+        if len(values) == 1:
+            values = values * len(width_list)
+        if len(values) != len(width_list):
+            raise ValueError("max_kb must give one budget, or one per width")
+        if not all(1 <= value <= 1000 for value in values):
+            raise ValueError("KB budgets must be between 1 and 1000.")
+        budgets = values
+
+    # A width listed twice keeps its first budget
+    by_width = dict(reversed(list(zip(width_list, budgets))))
+    specs = [
+        {"width": width, "format": fmt, "max_kb": by_width[width]}
+        for width in sorted(by_width, reverse=True)
+        for fmt in format_list
+    ]
+    if len(specs) > Config.VARIANT_MAX_COUNT:
+        raise ValueError(f"Too many variants. At most {Config.VARIANT_MAX_COUNT} widths x formats per request.")
+    return specs
+
+
+def _decode_for_width(data: bytes, width: int) -> Tuple[Image.Image, Tuple[int, int]]:
+    """Decode data with just enough resolution for the largest variant.
+
+    Like decode_for_target, JPEGs use a DCT-domain draft and other formats
+    reduce(), keeping DECODE_SHRINK_MARGIN above the requested width.
+    Returns the RGB(A) image and the source's full size.
+    """
+    img = Image.open(BytesIO(data))
+    full_width, full_height = img.size
+    factor = int(full_width / (width * Config.DECODE_SHRINK_MARGIN))
+    if factor >= 2:
+        if img.format in ('JPEG', 'MPO'):
+            img.draft(img.mode, (math.ceil(full_width / factor), math.ceil(full_height / factor)))
+        else:
+            img.load()
+            if img.mode not in ('RGB', 'RGBA', 'L'):
+                img = img.convert('RGBA' if img.has_transparency_data else 'RGB')
+            img = img.reduce(factor)
+    img.load()
+    if img.mode not in ('RGB', 'RGBA'):
+        img = img.convert('RGBA' if img.has_transparency_data else 'RGB')
+    return img, (full_width, full_height)
+
+
+def _flatten(img: Image.Image) -> Image.Image:
+    """Composite alpha over white (every variant encoder takes RGB)"""
+    if img.mode != 'RGBA':
+        return img
+    background = Image.new('RGB', img.size, (255, 255, 255))
+    background.paste(img, mask=img.getchannel('A'))
+    return background
+
+
+def _encode_variant(level: Image.Image, spec: Dict, effort: str) -> Tuple[bytes, Dict]:
+    """Encode one pyramid level; returns (bytes, manifest fields)"""
+    encoder = ENCODERS[spec["format"]]
+    started = time.perf_counter()
+    if spec["max_kb"] is None:
+        data = encoder.encode(level, Config.VARIANT_QUALITY, effort)
+        quality, encodes = Config.VARIANT_QUALITY, 1
+    else:
+        # The width is fixed, so only quality is searched
+        tolerance = Config.TARGET_SIZE_TOLERANCE_KB / 2
+        target = max(1.0, spec["max_kb"] - tolerance)
+        _, quality, _ = estimate_start(level, target, encoder=encoder)
+        result = encode_to_target_size(
+            level, target, tolerance_kb=tolerance, start=(1.0, quality),
+            encoder=encoder, effort=effort, rescale=False,
+        )
+        data, quality, encodes = result.buffer.getvalue(), result.quality, result.iterations
+    fields = {"quality": quality if encoder.searchable else None, "encodes": encodes,
+              "seconds": time.perf_counter() - started}
+    if spec["max_kb"] is not None:
+        fields["over_budget"] = len(data) > spec["max_kb"] * 1024
+    return data, fields
+
+
+def build_variants(data: bytes, specs: List[Dict], effort: Optional[str] = None) -> Tuple[bytes, Dict]:
+    """Decode data once and encode every variant in specs into a ZIP.
+
+    Levels are built largest first, each downscaled from the one before,
+    and each level's encodes start in a thread pool as soon as it exists.
+    Pillow releases the GIL while resizing and encoding, so the threads
+    overlap. The ZIP ends with a manifest.json that lists the variants and
+    a srcset string for each format. Returns (zip_bytes, stats).
+    """
+    effort = effort or Config.ENCODER_EFFORT
+    started = time.perf_counter()
+    level, (source_width, source_height) = _decode_for_width(data, specs[0]["width"])
+    decoded = time.perf_counter()
+
+    resize_seconds = 0.0
+    futures = []
+    with ThreadPoolExecutor(max_workers=min(len(specs), os.cpu_count() or 1)) as pool:
+        produced = set()
+        for spec in specs:
+            # Never upscale: widths beyond the source collapse onto it
+            width = min(spec["width"], source_width)
+            if (width, spec["format"]) in produced:
+                continue
+            produced.add((width, spec["format"]))
+            height = max(1, round(source_height * width / source_width))
+            if level.size != (width, height):
+                # Specs are sorted by width, so each level shrinks the last
+                resize_started = time.perf_counter()
+                level = level.resize((width, height), Image.LANCZOS, reducing_gap=2.0)
+                flat = _flatten(level)
+                resize_seconds += time.perf_counter() - resize_started
+            elif not futures:
+                flat = _flatten(level)
+            # A copy per task: save() stores encoder options on the image
+            futures.append((spec["format"], spec["max_kb"], width, height,
+                            pool.submit(_encode_variant, flat.copy(), spec, effort)))
+        results = [(fmt, max_kb, width, height, future.result())
+                   for fmt, max_kb, width, height, future in futures]
+    encoded = time.perf_counter()
+
+    archive = ZipStream()
+    chunks = []
+    manifest = []
+    srcsets: Dict[str, List[str]] = {}
+    for fmt, max_kb, width, height, (body, fields) in results:
+        name = f"{width}w.{_EXTENSIONS[ENCODERS[fmt].format]}"
+        chunks.append(archive.add(name, body))
+        manifest.append({
+            "name": name, "format": fmt, "width": width, "height": height,
+            "bytes": len(body), "max_kb": max_kb,
+            **{key: value for key, value in fields.items() if key != "seconds"},
+        })
+        srcsets.setdefault(fmt, []).append(f"{name} {width}w")
+    summary = {
+        "source": {"width": source_width, "height": source_height},
+        "variants": manifest,
+        "srcset": {fmt: ", ".join(entries) for fmt, entries in srcsets.items()},
+    }
+    chunks.append(archive.add("manifest.json", json.dumps(summary, indent=2).encode(), compress=True))
+    chunks.append(archive.close())
+    finished = time.perf_counter()
+
+    stats = {
+        "stages": {"decode": decoded - started, "resize": resize_seconds, "archive": finished - encoded},
+        "encodes": tuple(fields["seconds"] for *_, (_, fields) in results),
+        "worker": finished - started,
+    }
+    return b"".join(chunks), stats